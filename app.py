@@ -4,17 +4,33 @@ from dotenv import load_dotenv
 import google.generativeai as genai
 import json
 import time
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, date
 import pytz
 import uuid
+import threading
+import random
+import sqlite3
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeout
 import pandas as pd
+import numpy as np
 import yfinance as yf
 import requests
+from requests.adapters import HTTPAdapter
 import feedparser
 from bs4 import BeautifulSoup
 from typing import Dict, List
 import re
-from urllib.parse import urljoin
+import math
+import csv
+import unicodedata
+from urllib.parse import urljoin, urlsplit, urlunsplit, parse_qsl, urlencode
+import hashlib
+import html
+import tempfile
+import heapq
+import calendar
+from itertools import islice
 
 load_dotenv()
 
@@ -24,6 +40,23 @@ TAIWAN_TZ = pytz.timezone('Asia/Taipei')
 def get_taiwan_time():
     return datetime.now(TAIWAN_TZ)
 
+def format_relative_time(timestamp):
+    """將發布時間（UTC 時間戳）轉為「N小時前」等相對時間，於顯示時才計算"""
+    if not timestamp:
+        return "時間未知"
+    seconds = max(0, int(time.time() - timestamp))
+    if seconds >= 86400:
+        return f"{seconds // 86400}天前"
+    elif seconds > 3600:
+        return f"{seconds // 3600}小時前"
+    else:
+        return f"{seconds // 60}分鐘前"
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 本地資料目錄（歷史K線等持久化資料）
+DATA_DIR = os.environ.get("APP_DATA_DIR", os.path.join(APP_DIR, ".data"))
+
 # 支援Streamlit Cloud的環境變數讀取
 def get_api_key():
     if hasattr(st, "secrets") and "GOOGLE_API_KEY" in st.secrets:
@@ -139,54 +172,1624 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+# 美股交易日曆（NYSE 交易時段、假日與提早收盤）
+class MarketCalendar:
+    def __init__(self, timezone='America/New_York', open_time=(9, 30), close_time=(16, 0),
+                 early_close_time=(13, 0), open_ttl=60, closed_ttl=300, settle_minutes=20):
+        self.tz = pytz.timezone(timezone)
+        self.open_time = open_time
+        self.close_time = close_time
+        self.early_close_time = early_close_time
+        self.open_ttl = open_ttl
+        self.closed_ttl = closed_ttl
+        self.settle_minutes = settle_minutes
+        self._years = {}
+    
+    @staticmethod
+    def _nth_weekday(year, month, weekday, n):
+        """某月第 n 個星期幾（n=-1 表示最後一個）"""
+        if n > 0:
+            first = date(year, month, 1)
+            return first + timedelta(days=(weekday - first.weekday()) % 7 + 7 * (n - 1))
+        last = (date(year, month + 1, 1) if month < 12 else date(year + 1, 1, 1)) - timedelta(days=1)
+        return last - timedelta(days=(last.weekday() - weekday) % 7)
+    
+    @staticmethod
+    def _easter(year):
+        a = year % 19
+        b, c = divmod(year, 100)
+        d, e = divmod(b, 4)
+        f = (b + 8) // 25
+        g = (b - f + 1) // 3
+        h = (19 * a + b - d - g + 15) % 30
+        i, k = divmod(c, 4)
+        l = (32 + 2 * e + 2 * i - h - k) % 7
+        m = (a + 11 * h + 22 * l) // 451
+        month, day = divmod(h + l - 7 * m + 114, 31)
+        return date(year, month, day + 1)
+    
+    @staticmethod
+    def _observed(day):
+        if day.weekday() == 5:
+            return day - timedelta(days=1)
+        if day.weekday() == 6:
+            return day + timedelta(days=1)
+        return day
+    
+    def _year(self, year):
+        """計算並快取某年的休市日與提早收盤日"""
+        if year not in self._years:
+            holidays = set()
+            new_year = date(year, 1, 1)
+            # 元旦逢週六時 NYSE 不在前一週五補假
+            if new_year.weekday() != 5:
+                holidays.add(self._observed(new_year))
+            holidays.add(self._nth_weekday(year, 1, 0, 3))  # 馬丁路德金恩紀念日
+            holidays.add(self._nth_weekday(year, 2, 0, 3))  # 總統日
+            holidays.add(self._easter(year) - timedelta(days=2))  # 耶穌受難日
+            holidays.add(self._nth_weekday(year, 5, 0, -1))  # 陣亡將士紀念日
+            if year >= 2022:
+                holidays.add(self._observed(date(year, 6, 19)))  # 六月節
+            holidays.add(self._observed(date(year, 7, 4)))  # 獨立紀念日
+            holidays.add(self._nth_weekday(year, 9, 0, 1))  # 勞動節
+            thanksgiving = self._nth_weekday(year, 11, 3, 4)
+            holidays.add(thanksgiving)
+            holidays.add(self._observed(date(year, 12, 25)))  # 聖誕節
+            
+            early_closes = {thanksgiving + timedelta(days=1)}
+            for day in (date(year, 7, 3), date(year, 12, 24)):
+                if day.weekday() < 5 and day not in holidays:
+                    early_closes.add(day)
+            self._years[year] = (holidays, early_closes)
+        return self._years[year]
+    
+    def is_trading_day(self, day):
+        return day.weekday() < 5 and day not in self._year(day.year)[0]
+    
+    def session(self, day):
+        """某日的 (開盤, 收盤) 時間；休市日回傳 None"""
+        if not self.is_trading_day(day):
+            return None
+        close_time = self.early_close_time if day in self._year(day.year)[1] else self.close_time
+        open_dt = self.tz.localize(datetime(day.year, day.month, day.day, *self.open_time))
+        close_dt = self.tz.localize(datetime(day.year, day.month, day.day, *close_time))
+        return open_dt, close_dt
+    
+    def now(self):
+        return datetime.now(self.tz)
+    
+    def is_open(self, now=None):
+        now = (now or self.now()).astimezone(self.tz)
+        session = self.session(now.date())
+        return session is not None and session[0] <= now < session[1]
+    
+    def next_open(self, now=None):
+        """下一次開盤時間（若目前在交易時段內則為下一個交易日）"""
+        now = (now or self.now()).astimezone(self.tz)
+        day = now.date()
+        for _ in range(15):
+            session = self.session(day)
+            if session and session[0] > now:
+                return session[0]
+            day += timedelta(days=1)
+        return None
+    
+    def last_close(self, now=None):
+        now = (now or self.now()).astimezone(self.tz)
+        day = now.date()
+        for _ in range(15):
+            session = self.session(day)
+            if session and session[1] <= now:
+                return session[1]
+            day -= timedelta(days=1)
+        return None
+    
+    @staticmethod
+    def is_us_symbol(symbol):
+        """美股代碼：不含交易所後綴（如 .TW）、指數（^）或期貨/外匯（=）"""
+        return not any(mark in symbol for mark in '.^=')
+    
+    def symbol_quote_ttl(self, symbol, timestamp=None):
+        """依交易所決定報價效期：美股依本交易日曆，其他市場沒有對應的日曆，使用固定短效期"""
+        if self.is_us_symbol(symbol):
+            return self.quote_ttl(timestamp)
+        return self.open_ttl
+    
+    def quote_ttl(self, timestamp=None):
+        """報價快取秒數：交易中短效期；休市時快取到下次開盤"""
+        now = datetime.fromtimestamp(timestamp if timestamp is not None else time.time(), self.tz)
+        if self.is_open(now):
+            return self.open_ttl
+        
+        # 收盤後一段時間內報價仍可能修正，維持短效期
+        last_close = self.last_close(now)
+        if last_close and now - last_close < timedelta(minutes=self.settle_minutes):
+            return self.open_ttl
+        
+        next_open = self.next_open(now)
+        if next_open is None:
+            return self.closed_ttl
+        return max(self.closed_ttl, (next_open - now).total_seconds())
+
+# 抓取失敗標記：invalid=無效代碼、empty=查無資料、network=連線錯誤
+class QuoteError:
+    def __init__(self, kind, message=''):
+        self.kind = kind
+        self.message = message
+
+# 跨會話共用的報價快取
+class QuoteCache:
+    # 各類錯誤的退避時間（初始秒數, 上限秒數），連續失敗時倍增
+    BACKOFF = {
+        'invalid': (3600, 86400),
+        'empty': (300, 21600),
+        'network': (30, 900)
+    }
+    
+    def __init__(self, ttl=300, wait_timeout=30, ttl_func=None):
+        self.ttl = ttl
+        self.wait_timeout = wait_timeout
+        # ttl_func(股票代碼, 時間戳) 可依市場狀態動態決定效期，未設定時使用固定 ttl
+        self.ttl_func = ttl_func
+        self._entries = {}
+        self._failures = {}
+        self._inflight = {}
+        self._lock = threading.Lock()
+    
+    def _is_fresh(self, entry, now):
+        return entry is not None and now < entry['expires_at']
+    
+    def _entry(self, symbol, data, timestamp):
+        ttl = self.ttl_func(symbol, timestamp) if self.ttl_func else self.ttl
+        return {'data': data, 'timestamp': timestamp, 'expires_at': timestamp + ttl}
+    
+    def peek(self, symbol):
+        """取得快取資料（不論是否過期）"""
+        with self._lock:
+            entry = self._entries.get(symbol)
+        return entry['data'] if entry else None
+    
+    def set(self, symbol, data, timestamp=None):
+        with self._lock:
+            self._entries[symbol] = self._entry(symbol, data, timestamp if timestamp is not None else time.time())
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._failures.clear()
+    
+    def failure(self, symbol):
+        """取得股票仍在退避中的失敗紀錄"""
+        with self._lock:
+            failure = self._failures.get(symbol)
+            if failure and failure['retry_at'] > time.time():
+                return dict(failure)
+        return None
+    
+    def _backing_off(self, symbol, now):
+        failure = self._failures.get(symbol)
+        return failure is not None and failure['retry_at'] > now
+    
+    def _record_failure(self, symbol, error, now):
+        previous = self._failures.get(symbol)
+        count = previous['count'] + 1 if previous and previous['kind'] == error.kind else 1
+        base, cap = self.BACKOFF.get(error.kind, self.BACKOFF['network'])
+        self._failures[symbol] = {
+            'kind': error.kind,
+            'message': error.message,
+            'count': count,
+            'retry_at': now + min(cap, base * 2 ** (count - 1))
+        }
+    
+    def get_or_fetch(self, symbols, fetch_func, allow_stale=False):
+        """取得報價；同一股票同時間只會有一個請求，其餘請求等待其結果
+        
+        allow_stale=True 時，過期資料會直接回傳（附 stale/age 標記）並於背景更新。
+        """
+        return self._load(symbols, fetch_func, allow_stale=allow_stale)
+    
+    def refresh(self, symbols, fetch_func):
+        """強制重新獲取；已在進行中的請求不會重複發出"""
+        return self._load(symbols, fetch_func, force=True)
+    
+    def due_for_refresh(self, symbols, ahead):
+        """列出即將在 ahead 秒內過期（或尚無資料）的股票"""
+        now = time.time()
+        with self._lock:
+            return [
+                symbol for symbol in dict.fromkeys(symbols)
+                if symbol not in self._inflight and not self._backing_off(symbol, now) and (
+                    symbol not in self._entries or
+                    now >= self._entries[symbol]['expires_at'] - ahead
+                )
+            ]
+    
+    def _load(self, symbols, fetch_func, allow_stale=False, force=False):
+        now = time.time()
+        results = {}
+        leading = []
+        waiting = {}
+        revalidate = []
+        
+        with self._lock:
+            for symbol in dict.fromkeys(symbols):
+                entry = self._entries.get(symbol)
+                if not force and self._is_fresh(entry, now):
+                    results[symbol] = entry['data']
+                elif allow_stale and entry is not None:
+                    results[symbol] = dict(entry['data'], stale=True, age=int(now - entry['timestamp']))
+                    if symbol not in self._inflight and not self._backing_off(symbol, now):
+                        revalidate.append(symbol)
+                elif self._backing_off(symbol, now):
+                    continue
+                elif symbol in self._inflight:
+                    if not force:
+                        waiting[symbol] = self._inflight[symbol]
+                else:
+                    self._inflight[symbol] = threading.Event()
+                    leading.append(symbol)
+        
+        if revalidate:
+            threading.Thread(target=self.refresh, args=(revalidate, fetch_func), daemon=True).start()
+        
+        if leading:
+            fetched = {}
+            try:
+                fetched = fetch_func(leading) or {}
+            finally:
+                with self._lock:
+                    stamp = time.time()
+                    for symbol in leading:
+                        value = fetched.get(symbol)
+                        if value is None or isinstance(value, QuoteError):
+                            self._record_failure(symbol, value or QuoteError('empty'), stamp)
+                        else:
+                            self._entries[symbol] = self._entry(symbol, value, stamp)
+                            self._failures.pop(symbol, None)
+                        self._inflight.pop(symbol).set()
+            results.update({
+                symbol: fetched[symbol] for symbol in leading
+                if fetched.get(symbol) is not None and not isinstance(fetched[symbol], QuoteError)
+            })
+        
+        for symbol, event in waiting.items():
+            event.wait(self.wait_timeout)
+            with self._lock:
+                entry = self._entries.get(symbol)
+            if self._is_fresh(entry, time.time()):
+                results[symbol] = entry['data']
+        
+        return results
+
+# 背景報價更新：在快取過期前預先更新所有會話關注的股票
+class QuoteRefresher:
+    def __init__(self, cache, fetch_func, refresh_ahead=30, interval=5, session_timeout=900,
+                 metadata_cache=None, metadata_func=None):
+        self.cache = cache
+        self.fetch_func = fetch_func
+        # 公司名稱等基本資料也在背景補齊，頁面只讀取快取
+        self.metadata_cache = metadata_cache
+        self.metadata_func = metadata_func
+        self.refresh_ahead = refresh_ahead
+        self.interval = interval
+        self.session_timeout = session_timeout
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+    
+    def watch(self, session_id, symbols):
+        """登記某個會話目前的關注清單"""
+        with self._lock:
+            self._sessions[session_id] = {
+                'symbols': list(symbols),
+                'last_seen': time.time()
+            }
+    
+    def watched_symbols(self):
+        """所有仍活躍會話關注股票的聯集"""
+        now = time.time()
+        with self._lock:
+            for session_id in [sid for sid, s in self._sessions.items() if now - s['last_seen'] > self.session_timeout]:
+                del self._sessions[session_id]
+            return list(dict.fromkeys(
+                symbol for session in self._sessions.values() for symbol in session['symbols']
+            ))
+    
+    def refresh_once(self):
+        symbols = self.watched_symbols()
+        due = self.cache.due_for_refresh(symbols, self.refresh_ahead)
+        if due:
+            self.cache.refresh(due, self.fetch_func)
+        if self.metadata_cache is not None and symbols:
+            # 已快取的直接略過、過期的背景更新、失敗的依退避時間重試
+            self.metadata_cache.get_or_fetch(symbols, self.metadata_func, allow_stale=True)
+        return due
+    
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.refresh_once()
+            except Exception as e:
+                print(f"Quote refresher error: {e}")
+    
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="quote-refresher", daemon=True)
+            self._thread.start()
+    
+    def stop(self):
+        self._stop.set()
+
+# 本地歷史K線儲存（SQLite），依股票與週期增量同步
+class HistoryStore:
+    COLUMNS = ['Open', 'High', 'Low', 'Close', 'Adj Close', 'Volume']
+    
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # 以記憶體映射方式讀取資料庫檔案
+        self._conn.execute("PRAGMA mmap_size=268435456")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS bars (
+                symbol TEXT NOT NULL,
+                interval TEXT NOT NULL,
+                ts INTEGER NOT NULL,
+                open REAL, high REAL, low REAL, close REAL, adj_close REAL, volume REAL,
+                PRIMARY KEY (symbol, interval, ts)
+            ) WITHOUT ROWID
+        """)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS sync_state (
+                symbol TEXT NOT NULL,
+                interval TEXT NOT NULL,
+                synced_at REAL NOT NULL,
+                PRIMARY KEY (symbol, interval)
+            )
+        """)
+        self._conn.commit()
+    
+    def close(self):
+        with self._lock:
+            self._conn.close()
+    
+    @staticmethod
+    def _to_timestamps(index, interval):
+        index = pd.DatetimeIndex(index)
+        if interval.endswith(('d', 'wk', 'mo')):
+            # 日線以上只保留日期，避免不同時區版本產生重複K線
+            if index.tz is not None:
+                index = index.tz_localize(None)
+            index = index.normalize()
+        elif index.tz is not None:
+            index = index.tz_convert('UTC').tz_localize(None)
+        # 依 pandas 版本與資料來源，索引可能是 ns 或 s 等不同精度，統一換算成秒
+        return index.as_unit('s').asi8
+    
+    def append(self, symbol, interval, hist):
+        """寫入K線；同一時間點的K線以新資料覆蓋（當日K線盤中會變動）"""
+        hist = hist.dropna(subset=['Close'])
+        if hist.empty:
+            return 0
+        
+        timestamps = self._to_timestamps(hist.index, interval)
+        adj_close = hist['Adj Close'] if 'Adj Close' in hist else hist['Close']
+        volume = hist['Volume'].fillna(0) if 'Volume' in hist else pd.Series(0, index=hist.index)
+        rows = [
+            (symbol, interval, int(ts), float(o), float(h), float(l), float(c), float(a), float(v))
+            for ts, o, h, l, c, a, v in zip(
+                timestamps, hist['Open'], hist['High'], hist['Low'], hist['Close'], adj_close, volume
+            )
+        ]
+        
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO bars VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sync_state VALUES (?, ?, ?)",
+                (symbol, interval, time.time())
+            )
+            self._conn.commit()
+        return len(rows)
+    
+    def mark_synced(self, symbol, interval):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sync_state VALUES (?, ?, ?)",
+                (symbol, interval, time.time())
+            )
+            self._conn.commit()
+    
+    def last_timestamp(self, symbol, interval='1d'):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT MAX(ts) FROM bars WHERE symbol = ? AND interval = ?",
+                (symbol, interval)
+            ).fetchone()
+        return row[0] if row else None
+    
+    def synced_at(self, symbol, interval='1d'):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT synced_at FROM sync_state WHERE symbol = ? AND interval = ?",
+                (symbol, interval)
+            ).fetchone()
+        return row[0] if row else None
+    
+    def load(self, symbol, interval='1d', start=None, end=None, limit=None):
+        """讀取K線區間為 DataFrame；limit 表示只取最新的 N 根"""
+        query = "SELECT ts, open, high, low, close, adj_close, volume FROM bars WHERE symbol = ? AND interval = ?"
+        params = [symbol, interval]
+        if start is not None:
+            query += " AND ts >= ?"
+            params.append(int(pd.Timestamp(start).timestamp()))
+        if end is not None:
+            query += " AND ts <= ?"
+            params.append(int(pd.Timestamp(end).timestamp()))
+        if limit is not None:
+            query = f"SELECT * FROM ({query} ORDER BY ts DESC LIMIT ?) ORDER BY ts"
+            params.append(int(limit))
+        else:
+            query += " ORDER BY ts"
+        
+        with self._lock:
+            df = pd.read_sql_query(query, self._conn, params=params)
+        
+        df.index = pd.to_datetime(df.pop('ts'), unit='s')
+        df.index.name = 'Date'
+        df.columns = self.COLUMNS
+        return df
+    
+    def load_closes(self, symbols, interval='1d', start=None, adjusted=True):
+        """以單一查詢讀取多檔股票收盤價，回傳日期 x 股票的寬表"""
+        column = 'adj_close' if adjusted else 'close'
+        placeholders = ', '.join('?' * len(symbols))
+        query = f"SELECT symbol, ts, {column} AS close FROM bars WHERE interval = ? AND symbol IN ({placeholders})"
+        params = [interval, *symbols]
+        if start is not None:
+            query += " AND ts >= ?"
+            params.append(int(pd.Timestamp(start).timestamp()))
+        
+        with self._lock:
+            df = pd.read_sql_query(query, self._conn, params=params)
+        
+        wide = df.pivot(index='ts', columns='symbol', values='close').sort_index()
+        wide.index = pd.to_datetime(wide.index, unit='s')
+        wide.index.name = 'Date'
+        return wide.reindex(columns=list(symbols))
+
+# 中英文公司名稱 → 股票代碼索引（前綴樹 + n-gram 模糊比對）
+class SymbolResolver:
+    MAX_PREFIX_CANDIDATES = 10
+    
+    def __init__(self, entries):
+        self.entries = entries
+        self._exact = {}
+        self._trie = {}
+        self._keys = []
+        self._grams = {}
+        
+        # 依資料檔順序（熱門程度）建立索引，前綴節點只保留排名最前的候選
+        for entry_id, entry in enumerate(entries):
+            for key in dict.fromkeys([entry['symbol'], entry['name'], *entry['aliases']]):
+                key = self.normalize(key)
+                if not key:
+                    continue
+                self._exact.setdefault(key, [])
+                if entry_id not in self._exact[key]:
+                    self._exact[key].append(entry_id)
+                self._insert_prefix(key, entry_id)
+                
+                key_id = len(self._keys)
+                grams = self.ngrams(key)
+                self._keys.append((entry_id, len(grams)))
+                for gram in grams:
+                    self._grams.setdefault(gram, []).append(key_id)
+    
+    @classmethod
+    def from_csv(cls, path):
+        """從內建資料檔載入（欄位：symbol,name,aliases；別名以 | 分隔）"""
+        with open(path, encoding='utf-8') as f:
+            entries = [
+                {
+                    'symbol': row['symbol'],
+                    'name': row['name'],
+                    'aliases': [alias for alias in row.get('aliases', '').split('|') if alias]
+                }
+                for row in csv.DictReader(f)
+            ]
+        return cls(entries)
+    
+    @staticmethod
+    def normalize(text):
+        text = unicodedata.normalize('NFKC', text).lower()
+        return re.sub(r"[\s.,'&()/-]+", '', text)
+    
+    @staticmethod
+    def ngrams(text):
+        """字元雙連詞；單一字元時使用單字"""
+        if len(text) < 2:
+            return {text} if text else set()
+        return {text[i:i + 2] for i in range(len(text) - 1)}
+    
+    def _insert_prefix(self, key, entry_id):
+        node = self._trie
+        for char in key:
+            node = node.setdefault(char, {})
+            candidates = node.setdefault('', [])
+            if entry_id not in candidates and len(candidates) < self.MAX_PREFIX_CANDIDATES:
+                candidates.append(entry_id)
+    
+    def _prefix_candidates(self, key):
+        node = self._trie
+        for char in key:
+            node = node.get(char)
+            if node is None:
+                return []
+        return node.get('', [])
+    
+    def resolve(self, query, limit=8, min_score=0.5):
+        """回傳符合的股票清單 [{'symbol', 'name', 'match', 'score'}]，依分數排序"""
+        key = self.normalize(query)
+        if not key:
+            return []
+        
+        scores = {}
+        for entry_id in self._exact.get(key, []):
+            scores[entry_id] = (3.0, 'exact')
+        
+        for rank, entry_id in enumerate(self._prefix_candidates(key)):
+            if entry_id not in scores:
+                scores[entry_id] = (2.0 - rank * 0.01, 'prefix')
+        
+        # 以共同雙連詞計算 Dice 相似度，處理錯字與中文部分比對
+        query_grams = self.ngrams(key)
+        shared = {}
+        for gram in query_grams:
+            for key_id in self._grams.get(gram, ()):
+                shared[key_id] = shared.get(key_id, 0) + 1
+        for key_id, count in shared.items():
+            entry_id, gram_count = self._keys[key_id]
+            score = 2 * count / (len(query_grams) + gram_count)
+            if score >= min_score and score > scores.get(entry_id, (0, ''))[0]:
+                scores[entry_id] = (score, 'fuzzy')
+        
+        ranked = sorted(scores.items(), key=lambda item: (-item[1][0], item[0]))[:limit]
+        return [
+            {
+                'symbol': self.entries[entry_id]['symbol'],
+                'name': self.entries[entry_id]['name'],
+                'match': match,
+                'score': round(score, 3)
+            }
+            for entry_id, (score, match) in ranked
+        ]
+
+# 投資組合分析：以整體陣列運算計算報酬、風險與相關性
+class PortfolioAnalyzer:
+    TRADING_DAYS = 252
+    
+    def __init__(self, stock_manager, benchmark='SPY', lookback_days=365, max_entries=64):
+        self.stock_manager = stock_manager
+        self.benchmark = benchmark
+        self.lookback_days = lookback_days
+        self.max_entries = max_entries
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def analyze(self, symbols, as_of=None):
+        """分析關注清單；結果依 (關注清單, 基準日) 快取"""
+        as_of = as_of or datetime.now(pytz.timezone('America/New_York')).date()
+        key = (tuple(sorted(set(symbols))), as_of)
+        
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+        
+        start = as_of - timedelta(days=self.lookback_days)
+        symbols = list(key[0])
+        load_symbols = symbols if self.benchmark in symbols else symbols + [self.benchmark]
+        closes, errors = self.stock_manager.get_closes(load_symbols, start=start, return_errors=True)
+        result = self.compute(closes, self.benchmark, symbols)
+        
+        # 同步失敗或有股票完全沒有價格時結果不完整，不快取，下次重繪再重試
+        if errors or closes.empty or closes.reindex(columns=load_symbols).isna().all().any():
+            return result
+        
+        with self._lock:
+            self._cache[key] = result
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return result
+    
+    @classmethod
+    def compute(cls, closes, benchmark=None, symbols=None):
+        """由收盤價寬表計算各股與等權重組合的績效指標"""
+        closes = closes.sort_index().ffill()
+        returns = closes.pct_change(fill_method=None).iloc[1:]
+        bench_returns = returns[benchmark] if benchmark in returns else None
+        
+        if symbols is None:
+            symbols = [column for column in closes.columns if column != benchmark]
+        closes = closes[symbols]
+        returns = returns[symbols]
+        
+        first_valid = closes.bfill().iloc[0]
+        total_return = closes.iloc[-1] / first_valid - 1
+        periods = returns.count()
+        annual_return = (1 + total_return) ** (cls.TRADING_DAYS / periods.replace(0, np.nan)) - 1
+        volatility = returns.std() * np.sqrt(cls.TRADING_DAYS)
+        max_drawdown = (closes / closes.cummax() - 1).min()
+        
+        if bench_returns is not None and bench_returns.count() > 1:
+            demeaned = returns - returns.mean()
+            bench_demeaned = bench_returns - bench_returns.mean()
+            covariance = demeaned.mul(bench_demeaned, axis=0).sum() / (periods - 1)
+            beta = covariance / bench_returns.var()
+        else:
+            beta = pd.Series(np.nan, index=returns.columns)
+        
+        metrics = pd.DataFrame({
+            '總報酬率(%)': total_return * 100,
+            '年化報酬率(%)': annual_return * 100,
+            '年化波動率(%)': volatility * 100,
+            '最大回撤(%)': max_drawdown * 100,
+            'Beta': beta
+        }).round(2)
+        
+        # 等權重組合（每日再平衡）
+        portfolio_returns = returns.mean(axis=1)
+        portfolio_curve = (1 + portfolio_returns).cumprod()
+        portfolio_volatility = portfolio_returns.std() * np.sqrt(cls.TRADING_DAYS)
+        portfolio = {
+            'total_return': (portfolio_curve.iloc[-1] - 1) * 100 if len(portfolio_curve) else np.nan,
+            'volatility': portfolio_volatility * 100,
+            'max_drawdown': (portfolio_curve / portfolio_curve.cummax() - 1).min() * 100,
+            'beta': (
+                portfolio_returns.cov(bench_returns) / bench_returns.var()
+                if bench_returns is not None else np.nan
+            )
+        }
+        
+        return {
+            'metrics': metrics,
+            'correlation': returns.corr().round(2),
+            'portfolio': portfolio,
+            'start': closes.index[0] if len(closes) else None,
+            'end': closes.index[-1] if len(closes) else None
+        }
+
+# 上游來源熔斷器：連續失敗或錯誤率過高時斷開，冷卻後放行一次半開探測
+class CircuitOpenError(Exception):
+    pass
+
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+    
+    def __init__(self, name, failure_threshold=3, error_rate_threshold=0.5, min_calls=10,
+                 recovery_timeout=60, max_recovery_timeout=900, window=50):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.error_rate_threshold = error_rate_threshold
+        self.min_calls = min_calls
+        self.recovery_timeout = recovery_timeout
+        self.max_recovery_timeout = max_recovery_timeout
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.open_timeout = recovery_timeout
+        self.last_error = None
+        self.last_error_at = None
+        self.calls = deque(maxlen=window)  # 最近呼叫的 (是否成功, 延遲秒數)
+        self._probe_in_flight = False
+        self._probe_started = 0
+        self._lock = threading.Lock()
+    
+    def allow(self, now=None):
+        """是否放行這次呼叫；斷開期間直接拒絕，冷卻結束後只放行一個探測請求"""
+        now = time.time() if now is None else now
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and now - self.opened_at >= self.open_timeout:
+                self.state = self.HALF_OPEN
+                self._probe_in_flight = False
+            # 探測請求若遲遲沒有回報結果（例如被取消），冷卻時間過後再放行一次
+            if self.state == self.HALF_OPEN and (
+                    not self._probe_in_flight or now - self._probe_started >= self.open_timeout):
+                self._probe_in_flight = True
+                self._probe_started = now
+                return True
+            return False
+    
+    def record_success(self, latency):
+        with self._lock:
+            self.calls.append((True, latency))
+            self.consecutive_failures = 0
+            if self.state != self.CLOSED:
+                self.state = self.CLOSED
+                self.open_timeout = self.recovery_timeout
+                self._probe_in_flight = False
+    
+    def record_failure(self, latency, error=None, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            self.calls.append((False, latency))
+            self.consecutive_failures += 1
+            self.last_error = str(error) if error is not None else None
+            self.last_error_at = now
+            if self.state == self.HALF_OPEN:
+                # 探測失敗：重新斷開，冷卻時間加倍
+                self._open(now, min(self.max_recovery_timeout, self.open_timeout * 2))
+            elif self.state == self.CLOSED and (
+                    self.consecutive_failures >= self.failure_threshold or
+                    (len(self.calls) >= self.min_calls and self._error_rate() >= self.error_rate_threshold)):
+                self._open(now, self.recovery_timeout)
+    
+    def _open(self, now, timeout):
+        self.state = self.OPEN
+        self.opened_at = now
+        self.open_timeout = timeout
+        self._probe_in_flight = False
+    
+    def _error_rate(self):
+        return sum(1 for ok, _ in self.calls if not ok) / len(self.calls) if self.calls else 0.0
+    
+    def call(self, func, *args, **kwargs):
+        """經熔斷器呼叫 func；斷開時拋出 CircuitOpenError"""
+        if not self.allow():
+            raise CircuitOpenError(f"{self.name} 暫停中")
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            self.record_failure(time.perf_counter() - start, e)
+            raise
+        self.record_success(time.perf_counter() - start)
+        return result
+    
+    def snapshot(self, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            latencies = sorted(latency for _, latency in self.calls)
+            retry_in = None
+            if self.state == self.OPEN:
+                retry_in = max(0, self.opened_at + self.open_timeout - now)
+            return {
+                'name': self.name,
+                'state': self.state,
+                'calls': len(self.calls),
+                'error_rate': self._error_rate(),
+                'avg_latency': sum(latencies) / len(latencies) if latencies else None,
+                'p95_latency': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] if latencies else None,
+                'consecutive_failures': self.consecutive_failures,
+                'last_error': self.last_error,
+                'last_error_at': self.last_error_at,
+                'retry_in': retry_in
+            }
+
+# 各上游來源（每個 RSS feed、NewsAPI、yfinance）的熔斷器登錄表
+class SourceHealth:
+    def __init__(self, **breaker_kwargs):
+        self.breaker_kwargs = breaker_kwargs
+        self._breakers = {}
+        self._lock = threading.Lock()
+    
+    def breaker(self, name):
+        with self._lock:
+            if name not in self._breakers:
+                self._breakers[name] = CircuitBreaker(name, **self.breaker_kwargs)
+            return self._breakers[name]
+    
+    def snapshot(self):
+        with self._lock:
+            breakers = list(self._breakers.values())
+        return [breaker.snapshot() for breaker in breakers]
+
+# yf.download 以 yf.shared._DFS / _ERRORS 等全域變數保存結果，同時下載會互相覆蓋
+YF_DOWNLOAD_LOCK = threading.Lock()
+
 # 簡化的股票數據管理
 class StockDataManager:
-    def __init__(self):
-        self.cache = {}
-        self.cache_expiry = 300
+    # yfinance 錯誤訊息中代表連線或上游問題的關鍵字
+    NETWORK_ERROR_HINTS = (
+        'rate limit', 'too many requests', '429', 'timeout', 'timed out', 'connection',
+        'resolve', 'max retries', 'ssl', 'http error 5', 'internal server error', 'service unavailable'
+    )
+    
+    def __init__(self, cache=None, metadata_cache=None, history_store=None, fast_mode=True, health=None):
+        self.cache = cache if cache is not None else QuoteCache()
+        self.cache_expiry = self.cache.ttl
+        # 公司名稱等少變動的資料另外以長效期快取保存
+        self.metadata = metadata_cache if metadata_cache is not None else QuoteCache(ttl=86400)
+        self.history = history_store if history_store is not None else HistoryStore(os.path.join(DATA_DIR, 'history.db'))
+        self.fast_mode = fast_mode
+        self.breaker = (health if health is not None else SourceHealth()).breaker('yfinance')
     
     def get_stock_data(self, symbol):
-        current_time = time.time()
+        fetch_func = self._fetch_batch if self.fast_mode else self._fetch_full
+        return self._with_names(self.cache.get_or_fetch([symbol], fetch_func)).get(symbol)
+    
+    def _with_names(self, quotes):
+        """以基本資料快取中的公司名稱補上報價（報價可能在名稱取得前就已快取）"""
+        named = {}
+        for symbol, quote in quotes.items():
+            metadata = self.metadata.peek(symbol)
+            if metadata and quote.get('name') != metadata['name']:
+                quote = dict(quote, name=metadata['name'])
+            named[symbol] = quote
+        return named
+    
+    def get_history(self, symbol, start=None, end=None, interval='1d'):
+        """從本地儲存讀取歷史K線，超過快取時間才增量同步"""
+        synced_at = self.history.synced_at(symbol, interval)
+        if synced_at is None or time.time() - synced_at >= self.cache_expiry:
+            self.sync_history([symbol], interval=interval)
+        return self.history.load(symbol, interval=interval, start=start, end=end)
+    
+    def get_closes(self, symbols, start=None, interval='1d', return_errors=False):
+        """多檔股票收盤價寬表；超過快取時間的股票先批次增量同步
         
-        if symbol in self.cache:
-            if current_time - self.cache[symbol]['timestamp'] < self.cache_expiry:
-                return self.cache[symbol]['data']
+        return_errors=True 時回傳 (寬表, 同步失敗的股票 {symbol: QuoteError})。
+        """
+        now = time.time()
+        stale = [
+            symbol for symbol in symbols
+            if now - (self.history.synced_at(symbol, interval) or 0) >= self.cache_expiry
+        ]
+        errors = self.sync_history(stale, interval=interval) if stale else {}
+        closes = self.history.load_closes(symbols, interval=interval, start=start)
+        return (closes, errors) if return_errors else closes
+    
+    def sync_history(self, symbols, interval='1d', initial_period='1y'):
+        """增量同步K線：已有資料的股票只下載上次同步後的K線
         
-        try:
-            stock = yf.Ticker(symbol)
-            hist = stock.history(period="1d")
-            info = stock.info
+        回傳同步失敗的股票 {symbol: QuoteError}。
+        """
+        groups = {}
+        for symbol in dict.fromkeys(symbols):
+            last_ts = self.history.last_timestamp(symbol, interval)
+            if last_ts is None:
+                groups.setdefault(('period', initial_period), []).append(symbol)
+            else:
+                # 從最後一根K線重新下載，以更新盤中變動的當日K線
+                start = datetime.utcfromtimestamp(last_ts).strftime('%Y-%m-%d')
+                groups.setdefault(('start', start), []).append(symbol)
+        
+        errors = {}
+        for (key, value), group in groups.items():
+            if not self.breaker.allow():
+                errors.update({symbol: QuoteError('network', f"{self.breaker.name} 暫停中") for symbol in group})
+                continue
             
-            if not hist.empty:
-                current_price = hist['Close'].iloc[-1]
-                prev_close = info.get('previousClose', current_price)
-                change = current_price - prev_close
-                change_percent = (change / prev_close) * 100
-                
-                data = {
-                    'symbol': symbol,
-                    'price': round(current_price, 2),
-                    'change': round(change, 2),
-                    'change_percent': round(change_percent, 2),
-                    'volume': info.get('volume', 0),
-                    'name': info.get('longName', symbol)
-                }
-                
-                self.cache[symbol] = {
-                    'data': data,
-                    'timestamp': current_time
+            start_time = time.perf_counter()
+            try:
+                # 下載結果與錯誤都存在 yfinance 模組層級的變數中，下載與讀取錯誤必須一起序列化
+                with YF_DOWNLOAD_LOCK:
+                    df = yf.download(
+                        group,
+                        interval=interval,
+                        group_by="ticker",
+                        auto_adjust=False,
+                        threads=True,
+                        progress=False,
+                        **{key: value}
+                    )
+                    failed = self._download_errors(group)
+            except Exception as e:
+                self.breaker.record_failure(time.perf_counter() - start_time, e)
+                print(f"Stock history error: {e}")
+                errors.update({symbol: QuoteError('network', str(e)) for symbol in group})
+                continue
+            
+            # yf.download 不拋出例外：整批都以連線問題失敗時才算上游故障
+            if len(failed) == len(group) and all(
+                    self._classify_download_error(message, known=key == 'start', whole_group=len(group) > 1) == 'network'
+                    for message in failed.values()):
+                self.breaker.record_failure(time.perf_counter() - start_time, next(iter(failed.values())))
+            else:
+                self.breaker.record_success(time.perf_counter() - start_time)
+            
+            for symbol in group:
+                if symbol in failed:
+                    # 下載失敗的股票不標記為已同步，交由報價快取的退避機制處理
+                    errors[symbol] = QuoteError(self._classify_download_error(
+                        failed[symbol],
+                        known=key == 'start',
+                        whole_group=len(group) > 1 and len(failed) == len(group)
+                    ), failed[symbol])
+                    continue
+                try:
+                    if isinstance(df.columns, pd.MultiIndex):
+                        hist = df[symbol] if symbol in df.columns.get_level_values(0) else None
+                    else:
+                        hist = df if len(group) == 1 else None
+                    
+                    if hist is not None and self.history.append(symbol, interval, hist):
+                        continue
+                    if key == 'start':
+                        # 已有資料但區間內沒有新K線（例如休市），仍視為同步完成
+                        self.history.mark_synced(symbol, interval)
+                    else:
+                        errors[symbol] = QuoteError('empty')
+                except Exception as e:
+                    print(f"Stock history error ({symbol}): {e}")
+                    errors[symbol] = QuoteError('network', str(e))
+        
+        return errors
+    
+    @staticmethod
+    def _download_errors(group):
+        """yf.download 失敗時不會拋出例外，只把錯誤記在 yf.shared._ERRORS；回傳本批的 {symbol: 錯誤訊息}"""
+        registry = getattr(getattr(yf, 'shared', None), '_ERRORS', None) or {}
+        return {symbol: str(registry[symbol]) for symbol in group if symbol in registry}
+    
+    @classmethod
+    def _classify_download_error(cls, message, known=False, whole_group=False):
+        """判斷下載錯誤是連線問題還是無效代碼
+        
+        yfinance 在連線失敗時也可能回報「possibly delisted」，因此已有K線的股票、
+        或整批股票同時失敗時，一律視為連線問題。
+        """
+        message = message.lower()
+        if known or whole_group or any(hint in message for hint in cls.NETWORK_ERROR_HINTS):
+            return 'network'
+        return 'invalid'
+    
+    def validate_symbol(self, symbol):
+        """檢查股票代碼是否有效，回傳 (是否有效, 失敗類型)；結果會寫入快取"""
+        if self.get_stock_data(symbol) is not None:
+            return True, None
+        failure = self.cache.failure(symbol)
+        return False, failure['kind'] if failure else 'empty'
+    
+    def _fetch_metadata(self, symbols):
+        results = {}
+        for symbol in symbols:
+            try:
+                info = self.breaker.call(lambda: yf.Ticker(symbol).info)
+                results[symbol] = {
+                    'name': info.get('longName', symbol),
+                    'currency': info.get('currency', ''),
+                    'sector': info.get('sector', '')
                 }
+            except CircuitOpenError as e:
+                results[symbol] = QuoteError('network', str(e))
+            except Exception as e:
+                print(f"Stock metadata error ({symbol}): {e}")
+                results[symbol] = QuoteError('network', str(e))
+        return results
+    
+    def _fetch_full(self, symbols):
+        results = {}
+        for symbol in symbols:
+            try:
+                stock = yf.Ticker(symbol)
+                hist, info = self.breaker.call(lambda: (stock.history(period="1d"), stock.info))
                 
-                return data
-        except Exception as e:
-            print(f"Stock data error: {e}")
-            pass
-        return None
+                if not hist.empty:
+                    current_price = hist['Close'].iloc[-1]
+                    prev_close = info.get('previousClose', current_price)
+                    change = current_price - prev_close
+                    change_percent = (change / prev_close) * 100
+                    
+                    results[symbol] = {
+                        'symbol': symbol,
+                        'price': round(current_price, 2),
+                        'change': round(change, 2),
+                        'change_percent': round(change_percent, 2),
+                        'volume': info.get('volume', 0),
+                        'name': info.get('longName', symbol)
+                    }
+                    self.metadata.set(symbol, {
+                        'name': info.get('longName', symbol),
+                        'currency': info.get('currency', ''),
+                        'sector': info.get('sector', '')
+                    })
+                else:
+                    results[symbol] = QuoteError('invalid', '查無歷史價格')
+            except CircuitOpenError as e:
+                results[symbol] = QuoteError('network', str(e))
+            except Exception as e:
+                print(f"Stock data error: {e}")
+                results[symbol] = QuoteError('network', str(e))
+        return results
+    
+    def benchmark_quote_fetch(self, symbols):
+        """比較完整模式與實際使用的批次模式的冷啟動報價延遲（每檔股票）
+        
+        使用暫時的快取、K線庫與熔斷器，不影響正式資料，且每檔股票都從空的K線庫開始下載。
+        """
+        rows = []
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            history = HistoryStore(os.path.join(tmp_dir, 'history.db'))
+            bench = type(self)(
+                cache=QuoteCache(),
+                metadata_cache=QuoteCache(ttl=86400),
+                history_store=history,
+                health=SourceHealth()
+            )
+            try:
+                for symbol in symbols:
+                    row = {'symbol': symbol}
+                    for label, fetch_func in (('完整模式(ms)', bench._fetch_full), ('批次模式(ms)', bench._fetch_batch)):
+                        start = time.perf_counter()
+                        fetch_func([symbol])
+                        row[label] = round((time.perf_counter() - start) * 1000, 1)
+                    rows.append(row)
+            finally:
+                history.close()
+        return rows
+    
+    def _build_quote(self, symbol, hist):
+        """由日K線資料計算報價"""
+        hist = hist.dropna(subset=['Close'])
+        if hist.empty:
+            return None
+        
+        current_price = float(hist['Close'].iloc[-1])
+        prev_close = float(hist['Close'].iloc[-2]) if len(hist) > 1 else current_price
+        change = current_price - prev_close
+        change_percent = (change / prev_close) * 100 if prev_close else 0.0
+        
+        # K線不含公司名稱，沿用基本資料快取中的名稱
+        metadata = self.metadata.peek(symbol)
+        name = metadata['name'] if metadata else symbol
+        
+        return {
+            'symbol': symbol,
+            'price': round(current_price, 2),
+            'change': round(change, 2),
+            'change_percent': round(change_percent, 2),
+            'volume': int(hist['Volume'].iloc[-1]) if 'Volume' in hist else 0,
+            'name': name
+        }
+    
+    def get_many(self, symbols, allow_stale=False):
+        """批次獲取多檔股票報價，未快取的股票以單一請求下載"""
+        return self._with_names(self.cache.get_or_fetch(symbols, self._fetch_batch, allow_stale=allow_stale))
+    
+    def _fetch_batch(self, symbols):
+        """同步本地K線後，由最新兩根日K線計算報價"""
+        results = self.sync_history(symbols)
+        for symbol in symbols:
+            if symbol in results:
+                continue
+            try:
+                results[symbol] = self._build_quote(symbol, self.history.load(symbol, limit=5)) or QuoteError('empty')
+            except Exception as e:
+                print(f"Stock data error ({symbol}): {e}")
+                results[symbol] = QuoteError('network', str(e))
+        
+        return results
+
+# 共用的 HTTP 連線池：keep-alive、每主機連線上限、明確時限與抖動退避重試
+class HttpClient:
+    RETRY_STATUS = {429, 500, 502, 503, 504}
+    
+    def __init__(self, pool_connections=16, pool_maxsize=8, timeout=(3.05, 10),
+                 retries=2, backoff_base=0.5, backoff_max=8):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = 'WillAIAssistantPro/1.0 (+https://github.com/williams17-ai/will-ai-assistant-pro)'
+        # pool_block=True：每個主機最多 pool_maxsize 條連線，超過時等待而非另開連線
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, pool_block=True)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+    
+    def _backoff(self, attempt, response=None):
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return min(self.backoff_max, int(retry_after))
+        # full jitter：0 ~ base * 2^attempt 之間隨機
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+    
+    def get(self, url, timeout=None, retries=None, **kwargs):
+        """GET 請求；連線錯誤、逾時與 429/5xx 會以抖動退避重試"""
+        retries = self.retries if retries is None else retries
+        for attempt in range(retries + 1):
+            try:
+                response = self.session.get(url, timeout=timeout or self.timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= retries:
+                    raise
+                time.sleep(self._backoff(attempt))
+                continue
+            
+            if response.status_code in self.RETRY_STATUS and attempt < retries:
+                time.sleep(self._backoff(attempt, response))
+                continue
+            return response
+
+# 全文檢索倒排索引：英文單字 + 中日文雙連字，BM25 排序，支援 AND / OR 查詢
+class SearchIndex:
+    _CJK = '\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff'
+    _TOKEN_RE = re.compile(f'[{_CJK}]+|[^\\W_{_CJK}]+')
+    
+    def __init__(self, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self._postings = {}
+        self._doc_lengths = {}
+        self._doc_terms = {}
+        self._total_length = 0
+        # 供 MaxScore 估計分數上限：各詞彙出現過的最大詞頻、最短文件長度（刪除時不回調，仍是有效上限）
+        self._max_tf = {}
+        self._min_length = None
+        self._lock = threading.Lock()
+        # 在背景建立索引時先清除，建立完成後設定；建立期間仍可增量寫入
+        self.ready = threading.Event()
+        self.ready.set()
+    
+    @classmethod
+    def tokenize(cls, text):
+        """英文等以單字切分，中日文連續字串切成雙連字（單字則保留單字）"""
+        tokens = []
+        for match in cls._TOKEN_RE.finditer(unicodedata.normalize('NFKC', text or '').lower()):
+            word = match.group()
+            if '\u3040' <= word[0] <= '\ufaff':
+                if len(word) == 1:
+                    tokens.append(word)
+                else:
+                    tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+            else:
+                tokens.append(word)
+        return tokens
+    
+    @classmethod
+    def tokenize_spans(cls, text):
+        """與 tokenize 相同的切分方式，另附上每個詞彙在原文中的位置 [(token, start, end)]"""
+        spans = []
+        for match in cls._TOKEN_RE.finditer(text or ''):
+            word, start = match.group(), match.start()
+            if '\u3040' <= word[0] <= '\ufaff' and len(word) > 1:
+                spans.extend(
+                    (unicodedata.normalize('NFKC', word[i:i + 2]).lower(), start + i, start + i + 2)
+                    for i in range(len(word) - 1)
+                )
+            else:
+                spans.append((unicodedata.normalize('NFKC', word).lower(), start, match.end()))
+        return spans
+    
+    def highlight_spans(self, text, query):
+        """回傳原文中符合查詢詞彙的位置 [(start, end)]，相鄰或重疊的位置會合併"""
+        terms = {token for tokens in self.parse_query(query) for token in tokens}
+        spans = []
+        for token, start, end in self.tokenize_spans(text):
+            if token not in terms:
+                continue
+            if spans and start <= spans[-1][1]:
+                spans[-1] = (spans[-1][0], max(spans[-1][1], end))
+            else:
+                spans.append((start, end))
+        return spans
+    
+    def __len__(self):
+        return len(self._doc_lengths)
+    
+    def clear(self):
+        with self._lock:
+            self._postings.clear()
+            self._doc_lengths.clear()
+            self._doc_terms.clear()
+            self._total_length = 0
+            self._max_tf.clear()
+            self._min_length = None
+    
+    def add(self, doc_id, text):
+        """加入或更新文件"""
+        terms = {}
+        for token in self.tokenize(text):
+            terms[token] = terms.get(token, 0) + 1
+        
+        with self._lock:
+            self._remove(doc_id)
+            for term, tf in terms.items():
+                self._postings.setdefault(term, {})[doc_id] = tf
+                if tf > self._max_tf.get(term, 0):
+                    self._max_tf[term] = tf
+            length = sum(terms.values())
+            if self._min_length is None or length < self._min_length:
+                self._min_length = length
+            self._doc_lengths[doc_id] = length
+            self._doc_terms[doc_id] = list(terms)
+            self._total_length += length
+    
+    def remove(self, doc_id):
+        with self._lock:
+            self._remove(doc_id)
+    
+    def _remove(self, doc_id):
+        for term in self._doc_terms.pop(doc_id, ()):
+            postings = self._postings.get(term)
+            if postings is not None:
+                postings.pop(doc_id, None)
+                if not postings:
+                    del self._postings[term]
+                    self._max_tf.pop(term, None)
+        self._total_length -= self._doc_lengths.pop(doc_id, 0)
+    
+    def parse_query(self, query):
+        """以 OR（或 |）分隔的各組之間為聯集，組內詞彙為交集"""
+        groups = []
+        for group in re.split(r'\s+(?:OR|\|)\s+|\s*\|\s*', query.strip()):
+            tokens = self.tokenize(group)
+            if tokens:
+                groups.append(tokens)
+        return groups
+    
+    def search(self, query, limit=20):
+        """回傳 [(doc_id, score)]，依 BM25 分數由高到低"""
+        groups = self.parse_query(query)
+        if not groups or limit <= 0:
+            return []
+        
+        with self._lock:
+            matched = set()
+            for tokens in groups:
+                postings = [self._postings.get(token) for token in set(tokens)]
+                if not all(postings):
+                    continue
+                # 從最短的 posting list 開始取交集
+                postings.sort(key=len)
+                docs = set(postings[0])
+                for posting in postings[1:]:
+                    docs.intersection_update(posting)
+                    if not docs:
+                        break
+                matched |= docs
+            
+            if not matched:
+                return []
+            
+            doc_count = len(self._doc_lengths)
+            avg_length = self._total_length / doc_count if doc_count else 0
+            # MaxScore：以最大詞頻與最短文件長度估計每個詞彙的分數上限，依上限由高到低計分；
+            # 目前分數加上剩餘詞彙的上限仍不超過第 limit 名時，提早放棄這份文件
+            min_norm = self.k1 * (1 - self.b + self.b * self._min_length / avg_length)
+            terms = []
+            for token in {token for tokens in groups for token in tokens}:
+                postings = self._postings.get(token)
+                if postings:
+                    idf = math.log(1 + (doc_count - len(postings) + 0.5) / (len(postings) + 0.5))
+                    max_tf = self._max_tf[token]
+                    terms.append((idf * max_tf * (self.k1 + 1) / (max_tf + min_norm), idf, postings))
+            terms.sort(key=lambda term: term[0], reverse=True)
+            remaining = [0.0] * (len(terms) + 1)
+            for i in range(len(terms) - 1, -1, -1):
+                remaining[i] = remaining[i + 1] + terms[i][0]
+            
+            top = []  # 最小堆積 (分數, 順序, doc_id)，保留目前前 limit 名
+            for seq, doc_id in enumerate(matched):
+                threshold = top[0][0] if len(top) >= limit else -1.0
+                norm = self.k1 * (1 - self.b + self.b * self._doc_lengths[doc_id] / avg_length)
+                score = 0.0
+                for i, (_, idf, postings) in enumerate(terms):
+                    if score + remaining[i] <= threshold:
+                        break
+                    tf = postings.get(doc_id)
+                    if tf:
+                        score += idf * tf * (self.k1 + 1) / (tf + norm)
+                else:
+                    if len(top) < limit:
+                        heapq.heappush(top, (score, seq, doc_id))
+                    elif score > top[0][0]:
+                        heapq.heapreplace(top, (score, seq, doc_id))
+        
+        top.sort(key=lambda item: (-item[0], item[1]))
+        return [(doc_id, score) for score, _, doc_id in top]
+
+# 新聞文章庫（SQLite）：以正規化網址與標題雜湊去重，增量寫入並依保留期限清除
+class ArticleStore:
+    def __init__(self, path, retention_days=14):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.retention_days = retention_days
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS articles (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                url_hash TEXT UNIQUE,
+                title_hash TEXT UNIQUE,
+                title TEXT NOT NULL,
+                summary TEXT,
+                link TEXT,
+                source TEXT,
+                image TEXT,
+                published_at REAL,
+                ingested_at REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_articles_ingested ON articles (ingested_at)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_articles_time ON articles (COALESCE(published_at, ingested_at))")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS article_analyses (
+                article_id INTEGER PRIMARY KEY,
+                key_points TEXT,
+                industry_impact TEXT,
+                outlook TEXT,
+                model TEXT,
+                created_at REAL NOT NULL
+            )
+        """)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS analysis_usage (
+                day TEXT PRIMARY KEY,
+                calls INTEGER NOT NULL
+            )
+        """)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS api_usage (
+                source TEXT NOT NULL,
+                day TEXT NOT NULL,
+                calls INTEGER NOT NULL,
+                PRIMARY KEY (source, day)
+            )
+        """)
+        self._conn.commit()
+    
+    @staticmethod
+    def normalize_url(url):
+        """去除追蹤參數、錨點、www 與結尾斜線，讓同一篇文章的不同網址一致"""
+        if not url or url == '#':
+            return None
+        parts = urlsplit(url.strip())
+        host = parts.netloc.lower()
+        if host.startswith('www.'):
+            host = host[4:]
+        query = urlencode(sorted(
+            (key, value) for key, value in parse_qsl(parts.query)
+            if not key.lower().startswith('utm_') and key.lower() not in ('ref', 'source', 'guccounter')
+        ))
+        return urlunsplit(('https', host, parts.path.rstrip('/'), query, ''))
+    
+    @staticmethod
+    def normalize_title(title):
+        title = unicodedata.normalize('NFKC', title or '').lower()
+        return re.sub(r'[\W_]+', '', title)
+    
+    @staticmethod
+    def _hash(text):
+        return hashlib.sha1(text.encode('utf-8')).hexdigest() if text else None
+    
+    def add_articles(self, articles):
+        """寫入新文章，已存在（網址或標題重複）的文章略過；回傳新增的文章"""
+        now = time.time()
+        added = []
+        with self._lock:
+            for article in articles:
+                cursor = self._conn.execute(
+                    """INSERT OR IGNORE INTO articles
+                       (url_hash, title_hash, title, summary, link, source, image, published_at, ingested_at)
+                       VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                    (
+                        self._hash(self.normalize_url(article.get('link'))),
+                        self._hash(self.normalize_title(article.get('title'))),
+                        article.get('title', '無標題'),
+                        article.get('summary', ''),
+                        article.get('link', '#'),
+                        article.get('source', ''),
+                        article.get('image', ''),
+                        article.get('published_at'),
+                        now
+                    )
+                )
+                if cursor.rowcount:
+                    added.append(dict(article, id=cursor.lastrowid))
+            self._conn.commit()
+        return added
+    
+    def get_page(self, page=0, page_size=15):
+        """依發布時間由新到舊分頁讀取（無發布時間者以寫入時間代替）"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM articles ORDER BY COALESCE(published_at, ingested_at) DESC, id DESC LIMIT ? OFFSET ?",
+                (page_size, page * page_size)
+            ).fetchall()
+        return [dict(row) for row in rows]
+    
+    def count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM articles").fetchone()[0]
+    
+    def get_by_ids(self, article_ids):
+        """依傳入順序讀取指定文章"""
+        if not article_ids:
+            return []
+        placeholders = ', '.join('?' * len(article_ids))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT * FROM articles WHERE id IN ({placeholders})", list(article_ids)
+            ).fetchall()
+        by_id = {row['id']: dict(row) for row in rows}
+        return [by_id[article_id] for article_id in article_ids if article_id in by_id]
+    
+    def iter_documents(self):
+        """逐筆讀取 (id, 標題, 摘要)，供建立搜尋索引"""
+        with self._lock:
+            rows = self._conn.execute("SELECT id, title, summary FROM articles").fetchall()
+        for row in rows:
+            yield row['id'], row['title'], row['summary']
+    
+    def expire(self):
+        """刪除超過保留天數的文章，回傳被刪除文章的 id"""
+        cutoff = time.time() - self.retention_days * 86400
+        with self._lock:
+            expired = [row[0] for row in self._conn.execute("SELECT id FROM articles WHERE ingested_at < ?", (cutoff,))]
+            self._conn.execute("DELETE FROM articles WHERE ingested_at < ?", (cutoff,))
+            self._conn.execute("DELETE FROM article_analyses WHERE article_id NOT IN (SELECT id FROM articles)")
+            self._conn.commit()
+        return expired
+    
+    def save_analyses(self, analyses, model_name):
+        """寫入預先分析結果 [{'id', 'key_points', 'industry_impact', 'outlook'}]"""
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO article_analyses VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (item['id'], item.get('key_points', ''), item.get('industry_impact', ''),
+                     item.get('outlook', ''), model_name, now)
+                    for item in analyses
+                ]
+            )
+            self._conn.commit()
+    
+    def get_analyses(self, article_ids):
+        if not article_ids:
+            return {}
+        placeholders = ', '.join('?' * len(article_ids))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT * FROM article_analyses WHERE article_id IN ({placeholders})", list(article_ids)
+            ).fetchall()
+        return {row['article_id']: dict(row) for row in rows}
+    
+    def pending_analysis(self, limit=50):
+        """尚未預先分析的最新文章"""
+        with self._lock:
+            rows = self._conn.execute(
+                """SELECT * FROM articles WHERE id NOT IN (SELECT article_id FROM article_analyses)
+                   ORDER BY COALESCE(published_at, ingested_at) DESC LIMIT ?""",
+                (limit,)
+            ).fetchall()
+        return [dict(row) for row in rows]
+    
+    def reserve_analysis_call(self, day, budget):
+        """扣除一次當日分析額度；額度用完時回傳 False"""
+        with self._lock:
+            row = self._conn.execute("SELECT calls FROM analysis_usage WHERE day = ?", (day,)).fetchone()
+            calls = row[0] if row else 0
+            if calls >= budget:
+                return False
+            self._conn.execute("INSERT OR REPLACE INTO analysis_usage VALUES (?, ?)", (day, calls + 1))
+            self._conn.commit()
+        return True
+    
+    def reserve_api_call(self, source, day, budget):
+        """扣除一次外部新聞 API 的當日請求額度；額度用完時回傳 False"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT calls FROM api_usage WHERE source = ? AND day = ?", (source, day)
+            ).fetchone()
+            calls = row[0] if row else 0
+            if calls >= budget:
+                return False
+            self._conn.execute("INSERT OR REPLACE INTO api_usage VALUES (?, ?, ?)", (source, day, calls + 1))
+            self._conn.commit()
+        return True
+
+# RSS 摘要擷取：只去除一次標籤、串流截斷，並依文章 id 記憶結果
+class SummaryExtractor:
+    PARSERS = ('regex', 'lxml', 'html.parser')
+    # 只有後接標籤名稱、/、! 或 ? 的 < 才是標籤；其他的 < 視為文字（如「5 < 6」）
+    _TOKEN_RE = re.compile(r'<(script|style)\b.*?</\1\s*>|<!--.*?-->|<[a-z/!?][^>]*>|([^<]+|<)', re.S | re.I)
+    
+    def __init__(self, parser='regex', max_length=200, max_entries=5000):
+        self.parser = parser
+        self.max_length = max_length
+        self.max_entries = max_entries
+        self._memo = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def _text_chunks(self, markup, parser):
+        """依序產生文字片段，讓截斷可以提早停止"""
+        if parser == 'regex':
+            for match in self._TOKEN_RE.finditer(markup):
+                if match.group(2):
+                    yield html.unescape(match.group(2))
+        else:
+            try:
+                soup = BeautifulSoup(markup, parser)
+            except Exception:
+                # 未安裝 lxml 時改用內建解析器
+                soup = BeautifulSoup(markup, 'html.parser')
+            yield from soup.strings
+    
+    def _truncate(self, chunks):
+        parts = []
+        length = 0
+        for chunk in chunks:
+            chunk = re.sub(r'\s+', ' ', chunk)
+            parts.append(chunk)
+            length += len(chunk)
+            if length > self.max_length + 1:
+                break
+        text = re.sub(r'\s+', ' ', ''.join(parts)).strip()
+        return text[:self.max_length] + "..." if len(text) > self.max_length else text
+    
+    def extract(self, markup, key=None, parser=None):
+        """HTML 摘要轉純文字並截斷；key（entry id / GUID）相同時直接回傳先前結果"""
+        if key is not None:
+            with self._lock:
+                if key in self._memo:
+                    self._memo.move_to_end(key)
+                    return self._memo[key]
+        
+        summary = self._truncate(self._text_chunks(markup or '', parser or self.parser))
+        
+        if key is not None:
+            with self._lock:
+                self._memo[key] = summary
+                while len(self._memo) > self.max_entries:
+                    self._memo.popitem(last=False)
+        return summary
+    
+    def benchmark(self, corpus, repeat=3):
+        """以錄製的 feed 摘要比較各解析器（不使用記憶）與記憶命中的耗時"""
+        rows = []
+        for parser in self.PARSERS:
+            start = time.perf_counter()
+            for _ in range(repeat):
+                for markup in corpus:
+                    self.extract(markup, parser=parser)
+            elapsed = (time.perf_counter() - start) / repeat
+            rows.append({
+                '解析器': parser,
+                '總耗時(ms)': round(elapsed * 1000, 2),
+                '每篇(µs)': round(elapsed / max(len(corpus), 1) * 1e6, 1)
+            })
+        
+        memo = SummaryExtractor(self.parser, self.max_length, max(self.max_entries, len(corpus)))
+        for i, markup in enumerate(corpus):
+            memo.extract(markup, key=i)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for i, markup in enumerate(corpus):
+                memo.extract(markup, key=i)
+        elapsed = (time.perf_counter() - start) / repeat
+        rows.append({
+            '解析器': f"{self.parser}（記憶命中）",
+            '總耗時(ms)': round(elapsed * 1000, 2),
+            '每篇(µs)': round(elapsed / max(len(corpus), 1) * 1e6, 1)
+        })
+        return rows
 
 # 改進的新聞管理類
 class NewsManager:
-    def __init__(self):
+    def __init__(self, state_path=None, http=None, store=None, summarizer=None, index=None, pre_analyzer=None,
+                 health=None, newsapi_daily_budget=90):
         self.cache = {}
+        self.http = http if http is not None else HttpClient()
+        self.store = store if store is not None else ArticleStore(os.path.join(DATA_DIR, 'news.db'))
+        self.index = index if index is not None else self.build_index(self.store)
+        self.pre_analyzer = pre_analyzer
+        self.health = health if health is not None else SourceHealth()
+        self.manual_refresh_interval = 60  # 手動重新整理的最短間隔（秒）
+        # NewsAPI 免費方案每日 100 次請求；用量記在文章庫，重啟與多個工作程序都共用同一額度
+        self.newsapi_daily_budget = newsapi_daily_budget
+        self._refresh_lock = threading.Lock()
+        # 上次實際更新的時間，頻率限制依此判斷（不放在可清除的 cache 中）
+        self._last_refresh = 0
+        self._poller = None
         self.cache_expiry = 1800  # 30分鐘快取
         self.rss_feeds = [
             'https://techcrunch.com/feed/',
@@ -195,12 +1798,38 @@ class NewsManager:
             'https://www.wired.com/feed/rss',
             'https://arstechnica.com/feeds/rss/',
         ]
+        self.feed_timeout = (3.05, 8)  # 單一 feed 的連線/讀取時限
+        self.fetch_deadline = 10  # 所有 feed 的整體時限
+        self._executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="rss-fetch")
+        # 各 feed 的 ETag / Last-Modified 與上次解析結果，持久化以便重啟後沿用
+        self.state_path = state_path or os.path.join(DATA_DIR, 'feed_state.json')
+        self._state_lock = threading.Lock()
+        self._feed_state = self._load_json(self.state_path, {})
+        self.summarizer = summarizer if summarizer is not None else SummaryExtractor()
+        # 錄製最近抓到的原始摘要 HTML [(文章 id, HTML)]，供摘要解析效能測試使用；
+        # 同一篇文章只錄一次，有新文章時才寫回檔案
+        self.corpus_path = os.path.join(os.path.dirname(self.state_path), 'feed_corpus.json')
+        self.corpus_size = 500
+        self._corpus = deque(
+            (key, markup) for key, markup in self._load_json(self.corpus_path, [])[-self.corpus_size:]
+        )
+        self._corpus_keys = {key for key, _ in self._corpus}
+        self._corpus_dirty = False
         
     def get_newsapi_news(self, query="artificial intelligence", language="en", page_size=10):
         """使用 NewsAPI 獲取新聞"""
         if not news_api_key:
             return []
-            
+        
+        breaker = self.health.breaker('NewsAPI')
+        if not breaker.allow():
+            return []
+        # 當日額度用完時改用 RSS，不讓手動重新整理把 API 金鑰的配額耗盡
+        day = datetime.now(pytz.UTC).strftime('%Y-%m-%d')
+        if not self.store.reserve_api_call('NewsAPI', day, self.newsapi_daily_budget):
+            return []
+        
+        start = time.perf_counter()
         try:
             url = "https://newsapi.org/v2/everything"
             params = {
@@ -211,110 +1840,191 @@ class NewsManager:
                 'apiKey': news_api_key
             }
             
-            response = requests.get(url, params=params, timeout=10)
+            response = self.http.get(url, params=params)
+            response.raise_for_status()
             if response.status_code == 200:
                 data = response.json()
                 articles = []
                 
                 for article in data.get('articles', []):
                     # 解析發布時間
-                    published_at = article.get('publishedAt', '')
-                    if published_at:
+                    published_at = None
+                    if article.get('publishedAt'):
                         try:
-                            pub_time = datetime.fromisoformat(published_at.replace('Z', '+00:00'))
-                            time_diff = datetime.now(pytz.UTC) - pub_time
-                            if time_diff.days > 0:
-                                time_str = f"{time_diff.days}天前"
-                            elif time_diff.seconds > 3600:
-                                time_str = f"{time_diff.seconds // 3600}小時前"
-                            else:
-                                time_str = f"{time_diff.seconds // 60}分鐘前"
+                            published_at = datetime.fromisoformat(article['publishedAt'].replace('Z', '+00:00')).timestamp()
                         except Exception:
-                            time_str = "時間未知"
-                    else:
-                        time_str = "時間未知"
+                            pass
                     
                     articles.append({
                         'title': article.get('title', '無標題'),
                         'summary': article.get('description', '無摘要'),
                         'link': article.get('url', '#'),
-                        'published': time_str,
+                        'published_at': published_at,
                         'source': article.get('source', {}).get('name', '未知來源'),
                         'image': article.get('urlToImage', '')
                     })
                 
+                breaker.record_success(time.perf_counter() - start)
                 return articles
+            breaker.record_failure(time.perf_counter() - start, f"HTTP {response.status_code}")
         except Exception as e:
+            breaker.record_failure(time.perf_counter() - start, e)
             print(f"NewsAPI 錯誤: {e}")
             
         return []
     
-    def get_rss_news(self, max_articles=15):
-        """從 RSS feeds 獲取新聞"""
-        all_articles = []
+    @staticmethod
+    def _load_json(path, default):
+        try:
+            with open(path, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return default
+    
+    @staticmethod
+    def _save_json(path, data):
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"儲存錯誤 ({path}): {e}")
+    
+    @property
+    def corpus(self):
+        with self._state_lock:
+            return [markup for _, markup in self._corpus]
+    
+    def _record_corpus(self, key, markup):
+        """錄製尚未見過的文章摘要（呼叫端需持有 _state_lock）"""
+        if key in self._corpus_keys:
+            return
+        if len(self._corpus) >= self.corpus_size:
+            self._corpus_keys.discard(self._corpus.popleft()[0])
+        self._corpus.append((key, markup))
+        self._corpus_keys.add(key)
+        self._corpus_dirty = True
+    
+    def _save_feed_state(self):
+        with self._state_lock:
+            feed_state = dict(self._feed_state)
+            corpus = [list(item) for item in self._corpus] if self._corpus_dirty else None
+            self._corpus_dirty = False
+        self._save_json(self.state_path, feed_state)
+        if corpus is not None:
+            self._save_json(self.corpus_path, corpus)
+    
+    def _fetch_feed(self, feed_url, per_feed_limit=5):
+        """下載並解析單一 RSS feed；內容未變更（304）時沿用上次解析結果"""
+        with self._state_lock:
+            state = dict(self._feed_state.get(feed_url, {}))
         
-        for feed_url in self.rss_feeds:
-            try:
-                feed = feedparser.parse(feed_url)
-                
-                for entry in feed.entries[:5]:  # 每個feed最多取5篇
-                    # 解析發布時間
-                    published_time = "時間未知"
-                    if hasattr(entry, 'published_parsed') and entry.published_parsed:
-                        try:
-                            pub_time = datetime(*entry.published_parsed[:6], tzinfo=pytz.UTC)
-                            time_diff = datetime.now(pytz.UTC) - pub_time
-                            if time_diff.days > 0:
-                                published_time = f"{time_diff.days}天前"
-                            elif time_diff.seconds > 3600:
-                                published_time = f"{time_diff.seconds // 3600}小時前"
-                            else:
-                                published_time = f"{time_diff.seconds // 60}分鐘前"
-                        except Exception:
-                            pass
-                    
-                    # 取得摘要
-                    summary = ""
-                    if hasattr(entry, 'summary'):
-                        # 清理HTML標籤
-                        soup = BeautifulSoup(entry.summary, 'html.parser')
-                        summary = soup.get_text()[:200] + "..." if len(soup.get_text()) > 200 else soup.get_text()
-                    
-                    article = {
-                        'title': entry.get('title', '無標題'),
-                        'summary': summary or '無摘要',
-                        'link': entry.get('link', '#'),
-                        'published': published_time,
-                        'source': feed.feed.get('title', '未知來源'),
-                        'image': ''
-                    }
-                    
-                    # 嘗試獲取圖片
-                    if hasattr(entry, 'media_content') and entry.media_content:
-                        article['image'] = entry.media_content[0].get('url', '')
-                    elif hasattr(entry, 'enclosures') and entry.enclosures:
-                        for enclosure in entry.enclosures:
-                            if enclosure.type.startswith('image/'):
-                                article['image'] = enclosure.href
-                                break
-                    
-                    all_articles.append(article)
-                    
-            except Exception as e:
-                print(f"RSS feed 錯誤 ({feed_url}): {e}")
-                continue
+        headers = {}
+        if state.get('articles') is not None:
+            if state.get('etag'):
+                headers['If-None-Match'] = state['etag']
+            if state.get('last_modified'):
+                headers['If-Modified-Since'] = state['last_modified']
+        
+        response = self.http.get(feed_url, headers=headers, timeout=self.feed_timeout, retries=1)
+        if response.status_code == 304:
+            return state['articles']
+        response.raise_for_status()
+        feed = feedparser.parse(response.content)
+        articles = []
+        
+        for entry in feed.entries[:per_feed_limit]:  # 每個feed最多取5篇
+            # 解析發布時間（feedparser 的 *_parsed 為 UTC struct_time）
+            published_at = None
+            parsed_time = entry.get('published_parsed') or entry.get('updated_parsed')
+            if parsed_time:
+                try:
+                    published_at = float(calendar.timegm(parsed_time))
+                except Exception:
+                    pass
+            
+            # 取得摘要（清理HTML標籤，同一篇文章不重複解析）
+            summary = ""
+            if hasattr(entry, 'summary'):
+                key = entry.get('id') or entry.get('link')
+                summary = self.summarizer.extract(entry.summary, key=key)
+                with self._state_lock:
+                    self._record_corpus(key or entry.summary, entry.summary)
+            
+            article = {
+                'title': entry.get('title', '無標題'),
+                'summary': summary or '無摘要',
+                'link': entry.get('link', '#'),
+                'published_at': published_at,
+                'source': feed.feed.get('title', '未知來源'),
+                'image': ''
+            }
+            
+            # 嘗試獲取圖片
+            if hasattr(entry, 'media_content') and entry.media_content:
+                article['image'] = entry.media_content[0].get('url', '')
+            elif hasattr(entry, 'enclosures') and entry.enclosures:
+                for enclosure in entry.enclosures:
+                    if enclosure.type.startswith('image/'):
+                        article['image'] = enclosure.href
+                        break
+            
+            articles.append(article)
+        
+        articles.sort(key=lambda article: article['published_at'] or 0, reverse=True)
+        
+        with self._state_lock:
+            self._feed_state[feed_url] = {
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'articles': articles
+            }
+        return articles
+    
+    def get_rss_news(self, max_articles=15, deadline=None):
+        """從 RSS feeds 並行獲取新聞；超過整體時限時回傳已完成的部分結果"""
+        # 經各 feed 的熔斷器呼叫；斷開中的 feed 立即略過，不再等到逾時
+        futures = {
+            self._executor.submit(self.health.breaker(feed_url).call, self._fetch_feed, feed_url): feed_url
+            for feed_url in self.rss_feeds
+        }
+        feed_articles = {}
+        
+        try:
+            for future in as_completed(futures, timeout=deadline or self.fetch_deadline):
+                feed_url = futures[future]
+                try:
+                    feed_articles[feed_url] = future.result()
+                except CircuitOpenError:
+                    pass
+                except Exception as e:
+                    print(f"RSS feed 錯誤 ({feed_url}): {e}")
+        except FuturesTimeout:
+            print(f"RSS 逾時，僅取得 {len(feed_articles)}/{len(futures)} 個來源")
+            for future in futures:
+                future.cancel()
         
-        # 根據時間排序並限制數量
-        return all_articles[:max_articles]
+        self._save_feed_state()
+        
+        # 各 feed 已依時間由新到舊排序，以 heap 做 k 路合併，取到 max_articles 篇即停止
+        merged = heapq.merge(
+            *(feed_articles[feed_url] for feed_url in self.rss_feeds if feed_url in feed_articles),
+            key=lambda article: article.get('published_at') or 0,
+            reverse=True
+        )
+        return list(islice(merged, max_articles))
     
     def get_fallback_news(self):
         """備用新聞（當API都無法使用時）"""
+        now = time.time()
         return [
             {
                 'title': 'Google Gemini 2.5 Flash 效能大幅提升',
                 'summary': 'Google最新發布的Gemini 2.5 Flash在多項AI基準測試中表現優異，特別在程式碼生成和數學推理方面有顯著提升，處理速度比前一版本快30%。',
                 'link': '#',
-                'published': '2小時前',
+                'published_at': now - 2 * 3600,
                 'source': 'AI科技新聞',
                 'image': ''
             },
@@ -322,7 +2032,7 @@ class NewsManager:
                 'title': 'OpenAI GPT-5 開發進展最新消息',
                 'summary': '據可靠消息來源，OpenAI正在加速GPT-5的開發進程，新模型預計將在推理能力、多模態處理和程式碼生成方面帶來革命性改進。',
                 'link': '#',
-                'published': '4小時前',
+                'published_at': now - 4 * 3600,
                 'source': 'TechCrunch',
                 'image': ''
             },
@@ -330,7 +2040,7 @@ class NewsManager:
                 'title': 'AI醫療診斷準確率創新高',
                 'summary': '最新研究顯示，AI系統在皮膚癌、眼科疾病等特定領域的診斷準確率已經超越資深醫生，為醫療行業數位轉型提供強力支撐。',
                 'link': '#',
-                'published': '6小時前',
+                'published_at': now - 6 * 3600,
                 'source': 'The Verge',
                 'image': ''
             },
@@ -338,7 +2048,7 @@ class NewsManager:
                 'title': '微軟Copilot整合新功能發布',
                 'summary': 'Microsoft宣布Copilot將整合更多Office應用，包括PowerPoint自動生成、Excel智能分析等功能，預計下月正式上線。',
                 'link': '#',
-                'published': '8小時前',
+                'published_at': now - 8 * 3600,
                 'source': 'Microsoft新聞',
                 'image': ''
             },
@@ -346,20 +2056,35 @@ class NewsManager:
                 'title': 'AI晶片市場競爭白熱化',
                 'summary': 'NVIDIA、AMD、Intel在AI晶片領域展開激烈競爭，新一代產品性能提升的同時，價格戰也正式開打，預計將促進AI技術普及。',
                 'link': '#',
-                'published': '12小時前',
+                'published_at': now - 12 * 3600,
                 'source': 'Wired',
                 'image': ''
             }
         ]
     
-    def get_news(self, force_refresh=False):
-        """統一的新聞獲取介面"""
-        current_time = time.time()
-        
-        if not force_refresh and 'news' in self.cache:
-            if current_time - self.cache['news']['timestamp'] < self.cache_expiry:
-                return self.cache['news']['data']
+    def refresh(self, min_interval=0):
+        """更新文章庫，回傳新增篇數
         
+        同時間只會有一個更新在進行；距上次更新不到 min_interval 秒時略過並回傳 None，
+        因此多個會話同時要求更新時只會真正抓取一次。
+        """
+        with self._refresh_lock:
+            if time.time() - self._last_refresh < min_interval:
+                return None
+            added = self._refresh()
+            self._last_refresh = time.time()
+            self.cache['news'] = {
+                'added': added,
+                'timestamp': time.time()
+            }
+            return added
+    
+    def request_refresh(self):
+        """使用者手動重新整理（有頻率限制）"""
+        return self.refresh(min_interval=self.manual_refresh_interval)
+    
+    def _refresh(self):
+        """抓取新聞並只寫入新文章，回傳新增篇數"""
         # 優先嘗試 NewsAPI
         news_articles = []
         if news_api_key:
@@ -369,121 +2094,1021 @@ class NewsManager:
         if not news_articles:
             news_articles = self.get_rss_news()
         
+        added = self.store.add_articles(news_articles)
+        
+        # 搜尋索引在寫入時就更新，查詢時不需重新掃描
+        for article in added:
+            self.index.add(article['id'], self._index_text(article['title'], article['summary']))
+        for article_id in self.store.expire():
+            self.index.remove(article_id)
+        
+        if self.pre_analyzer:
+            # 連同先前因額度用完或請求失敗而尚未分析的文章一併排入，讓它們在之後的更新中重試
+            self.pre_analyzer.submit(
+                added + self.store.pending_analysis(limit=self.pre_analyzer.batch_size * 2)
+            )
+        return len(added)
+    
+    @staticmethod
+    def _index_text(title, summary):
+        # 標題重複一次以提高權重
+        return f"{title} {title} {summary or ''}"
+    
+    @classmethod
+    def build_index(cls, store):
+        index = SearchIndex()
+        for article_id, title, summary in store.iter_documents():
+            index.add(article_id, cls._index_text(title, summary))
+        return index
+    
+    def search(self, query, limit=50):
+        """全文搜尋文章庫，回傳依相關度排序的文章"""
+        article_ids = [article_id for article_id, _ in self.index.search(query, limit=limit)]
+        return self.store.get_by_ids(article_ids)
+    
+    def refresh_due(self):
+        return 'news' not in self.cache or time.time() - self.cache['news']['timestamp'] >= self.cache_expiry
+    
+    def _poll(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                if self.refresh_due():
+                    self.refresh()
+            except Exception as e:
+                print(f"News poller error: {e}")
+    
+    def start_poller(self, interval=30):
+        """啟動背景輪詢，依 cache_expiry 定期更新文章庫"""
+        if self._poller is None or not self._poller.is_alive():
+            self._poller = threading.Thread(target=self._poll, args=(interval,), name="news-poller", daemon=True)
+            self._poller.start()
+    
+    def get_news(self, force_refresh=False, page=0, page_size=15):
+        """統一的新聞獲取介面（分頁讀取文章庫，更新交由背景輪詢）"""
+        if force_refresh:
+            self.request_refresh()
+        elif 'news' not in self.cache and self.store.count() == 0:
+            # 首次啟動且文章庫為空時才同步抓取
+            self.refresh(min_interval=self.manual_refresh_interval)
+        
+        news_articles = self.store.get_page(page, page_size)
+        
         # 如果都沒有結果，使用備用新聞
-        if not news_articles:
+        if not news_articles and page == 0:
             news_articles = self.get_fallback_news()
         
-        # 快取結果
-        self.cache['news'] = {
-            'data': news_articles,
-            'timestamp': current_time
-        }
-        
         return news_articles
+    
+    def total_pages(self, page_size=15):
+        return max(1, -(-self.store.count() // page_size))
+
+# 新聞預先分析：新文章寫入後，於背景以單一 Gemini JSON 請求批次分析多則標題
+class NewsPreAnalyzer:
+    PROMPT = """請用繁體中文分析以下每一則科技新聞，並只回覆 JSON 陣列，每則新聞一個物件：
+[{{"id": 新聞編號, "key_points": "新聞重點摘要", "industry_impact": "對科技產業的影響", "outlook": "未來發展預測"}}]
+
+{articles}"""
+    
+    def __init__(self, model, store, model_name, batch_size=8, concurrency=2, daily_budget=40):
+        self.model = model
+        self.store = store
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.daily_budget = daily_budget
+        self._queued = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="news-analysis")
+    
+    def submit(self, articles):
+        """排入背景分析；已在佇列中（或同一批重複出現）的文章不重複排入"""
+        queued = []
+        with self._lock:
+            for article in articles:
+                if article.get('id') and article['id'] not in self._queued:
+                    self._queued.add(article['id'])
+                    queued.append(article)
+        articles = queued
+        for i in range(0, len(articles), self.batch_size):
+            self._executor.submit(self._run_batch, articles[i:i + self.batch_size])
+    
+    def _run_batch(self, batch):
+        try:
+            day = datetime.now(pytz.UTC).strftime('%Y-%m-%d')
+            if not self.store.reserve_analysis_call(day, self.daily_budget):
+                print("新聞預先分析：今日額度已用完")
+                return
+            
+            articles_text = "\n\n".join(
+                f"新聞編號：{article['id']}\n標題：{article['title']}\n摘要：{article.get('summary', '')}"
+                for article in batch
+            )
+            response = self.model.generate_content(
+                self.PROMPT.format(articles=articles_text),
+                generation_config={'response_mime_type': 'application/json'}
+            )
+            results = json.loads(response.text)
+            if isinstance(results, dict):
+                results = results.get('articles', [])
+            
+            batch_ids = {article['id'] for article in batch}
+            analyses = []
+            for item in results:
+                try:
+                    item['id'] = int(item.get('id'))
+                except (TypeError, ValueError):
+                    continue
+                if item['id'] in batch_ids:
+                    analyses.append(item)
+            self.store.save_analyses(analyses, self.model_name)
+        except Exception as e:
+            print(f"新聞預先分析錯誤: {e}")
+        finally:
+            with self._lock:
+                self._queued.difference_update(article['id'] for article in batch)
+
+# AI 新聞分析快取：以內容雜湊為鍵，跨會話共用並持久化，超過容量時淘汰最久未使用者
+class AnalysisCache:
+    def __init__(self, path, max_bytes=20 * 1024 * 1024):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS analyses (
+                key TEXT PRIMARY KEY,
+                content TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_analyses_access ON analyses (last_access)")
+        self._conn.commit()
+    
+    @staticmethod
+    def make_key(*parts):
+        return hashlib.sha256(json.dumps(parts, ensure_ascii=False).encode('utf-8')).hexdigest()
+    
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT content FROM analyses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("UPDATE analyses SET last_access = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+        return row[0]
+    
+    def put(self, key, content):
+        now = time.time()
+        size = len(content.encode('utf-8'))
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO analyses VALUES (?, ?, ?, ?, ?)",
+                (key, content, size, now, now)
+            )
+            self._evict()
+            self._conn.commit()
+    
+    def _evict(self):
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM analyses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        expired = []
+        for key, size in self._conn.execute("SELECT key, size FROM analyses ORDER BY last_access"):
+            if total <= self.max_bytes:
+                break
+            expired.append((key,))
+            total -= size
+        self._conn.executemany("DELETE FROM analyses WHERE key = ?", expired)
+    
+    def stats(self):
+        with self._lock:
+            count, total = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM analyses").fetchone()
+        return {'entries': count, 'bytes': total}
+
+# 對話記錄持久化（SQLite WAL）：逐則寫入，清單只讀標題，訊息依需要分頁載入
+class ChatStore:
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS chats (
+                chat_id TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                title TEXT NOT NULL,
+                created_at TEXT NOT NULL,
+                updated_at REAL NOT NULL,
+                message_count INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_chats_owner ON chats (owner, updated_at)")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                user TEXT NOT NULL,
+                ai TEXT NOT NULL,
+                timestamp TEXT NOT NULL,
+                ttft REAL,
+                UNIQUE (chat_id, seq)
+            )
+        """)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS chat_summaries (
+                chat_id TEXT PRIMARY KEY,
+                upto INTEGER NOT NULL,
+                text TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        self._conn.commit()
+    
+    @staticmethod
+    def _chat(row):
+        return {
+            'chat_id': row['chat_id'],
+            'title': row['title'],
+            'created_at': datetime.fromisoformat(row['created_at']),
+            'message_count': row['message_count']
+        }
+    
+    @staticmethod
+    def _message(row):
+        return {
+            'id': row['id'],
+            'user': row['user'],
+            'ai': row['ai'],
+            'timestamp': datetime.fromisoformat(row['timestamp']),
+            'ttft': row['ttft'],
+            'message_index': row['seq']
+        }
+    
+    def append_message(self, owner, chat_id, title, user_message, ai_response, timestamp, ttft=None):
+        """附加一則訊息（對話不存在時一併建立），回傳訊息 id"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                """INSERT OR IGNORE INTO chats (chat_id, owner, title, created_at, updated_at)
+                   VALUES (?, ?, ?, ?, ?)""",
+                (chat_id, owner, title, timestamp.isoformat(), time.time())
+            )
+            seq = self._conn.execute(
+                "SELECT message_count FROM chats WHERE chat_id = ?", (chat_id,)
+            ).fetchone()['message_count']
+            cursor = self._conn.execute(
+                "INSERT INTO messages (chat_id, seq, user, ai, timestamp, ttft) VALUES (?, ?, ?, ?, ?, ?)",
+                (chat_id, seq, user_message, ai_response, timestamp.isoformat(), ttft)
+            )
+            self._conn.execute(
+                "UPDATE chats SET message_count = message_count + 1, updated_at = ? WHERE chat_id = ?",
+                (time.time(), chat_id)
+            )
+            return cursor.lastrowid
+    
+    def list_chats(self, owner, limit=None, offset=0):
+        """對話清單（只含標題等摘要資訊），最近更新的在前"""
+        with self._lock:
+            rows = self._conn.execute(
+                """SELECT chat_id, title, created_at, message_count FROM chats
+                   WHERE owner = ? ORDER BY updated_at DESC LIMIT ? OFFSET ?""",
+                (owner, -1 if limit is None else limit, offset)
+            ).fetchall()
+        return [self._chat(row) for row in rows]
+    
+    def get_chat(self, owner, chat_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT chat_id, title, created_at, message_count FROM chats WHERE chat_id = ? AND owner = ?",
+                (chat_id, owner)
+            ).fetchone()
+        return self._chat(row) if row else None
+    
+    def get_messages(self, chat_id, offset=0, limit=None):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM messages WHERE chat_id = ? ORDER BY seq LIMIT ? OFFSET ?",
+                (chat_id, -1 if limit is None else limit, offset)
+            ).fetchall()
+        return [self._message(row) for row in rows]
+    
+    def get_summary(self, chat_id):
+        """對話的滾動摘要：{'upto': 已摺疊的訊息數, 'text': 摘要}"""
+        with self._lock:
+            row = self._conn.execute("SELECT upto, text FROM chat_summaries WHERE chat_id = ?", (chat_id,)).fetchone()
+        return {'upto': row['upto'], 'text': row['text']} if row else {'upto': 0, 'text': ''}
+    
+    def save_summary(self, chat_id, upto, text):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO chat_summaries (chat_id, upto, text, updated_at) VALUES (?, ?, ?, ?)",
+                (chat_id, upto, text, time.time())
+            )
+    
+    def get_messages_by_ids(self, message_ids):
+        """依訊息 id 讀取訊息（含所屬對話標題），回傳 {id: message}"""
+        if not message_ids:
+            return {}
+        placeholders = ','.join('?' * len(message_ids))
+        with self._lock:
+            rows = self._conn.execute(
+                f"""SELECT m.*, c.title FROM messages m JOIN chats c ON c.chat_id = m.chat_id
+                    WHERE m.id IN ({placeholders})""",
+                list(message_ids)
+            ).fetchall()
+        return {row['id']: dict(self._message(row), chat_id=row['chat_id'], title=row['title']) for row in rows}
+    
+    def message_ids(self, chat_id):
+        with self._lock:
+            return [row['id'] for row in self._conn.execute("SELECT id FROM messages WHERE chat_id = ?", (chat_id,))]
+    
+    def count(self, owner):
+        """回傳 (對話數, 訊息數)"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT COUNT(*) AS chats, COALESCE(SUM(message_count), 0) AS messages FROM chats WHERE owner = ?",
+                (owner,)
+            ).fetchone()
+        return row['chats'], row['messages']
+    
+    def iter_messages(self, owner, batch_size=500):
+        """依寫入順序逐批讀出所有訊息（含所屬對話標題），不一次載入全部"""
+        last_id = 0
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    """SELECT m.*, c.title FROM messages m JOIN chats c ON c.chat_id = m.chat_id
+                       WHERE c.owner = ? AND m.id > ? ORDER BY m.id LIMIT ?""",
+                    (owner, last_id, batch_size)
+                ).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield dict(self._message(row), chat_id=row['chat_id'], title=row['title'])
+            last_id = rows[-1]['id']
+    
+    def delete_chats(self, owner, chat_ids=None):
+        """刪除指定對話（None 表示全部），回傳被刪除的對話 id"""
+        with self._lock, self._conn:
+            if chat_ids is None:
+                chat_ids = [row['chat_id'] for row in self._conn.execute(
+                    "SELECT chat_id FROM chats WHERE owner = ?", (owner,)
+                )]
+            else:
+                placeholders = ','.join('?' * len(chat_ids))
+                chat_ids = [row['chat_id'] for row in self._conn.execute(
+                    f"SELECT chat_id FROM chats WHERE owner = ? AND chat_id IN ({placeholders})",
+                    (owner, *chat_ids)
+                )]
+            for chat_id in chat_ids:
+                self._conn.execute("DELETE FROM messages WHERE chat_id = ?", (chat_id,))
+                self._conn.execute("DELETE FROM chat_summaries WHERE chat_id = ?", (chat_id,))
+                self._conn.execute("DELETE FROM chats WHERE chat_id = ?", (chat_id,))
+        return chat_ids
 
 # 改進的聊天管理類
 class ChatManager:
-    def __init__(self):
-        self.chats = {}
+    def __init__(self, store=None, owner='default', index=None):
+        self.store = store if store is not None else ChatStore(os.path.join(DATA_DIR, 'chats.db'))
+        self.owner = owner
+        self.index = index if index is not None else self.build_index(self.store, owner)
         self.settings = {
             'personality': '友善',
             'response_length': 3,
             'auto_save': True
         }
     
-    def add_message(self, chat_id, user_message, ai_response, timestamp=None):
-        """添加對話記錄"""
+    def add_message(self, chat_id, user_message, ai_response, timestamp=None, ttft=None):
+        """添加對話記錄（立即寫入儲存區；ttft：AI回應的首字延遲秒數）"""
         if timestamp is None:
             timestamp = get_taiwan_time()
         
-        if chat_id not in self.chats:
-            self.chats[chat_id] = {
-                'title': user_message[:30] + "..." if len(user_message) > 30 else user_message,
-                'messages': [],
-                'created_at': timestamp
-            }
+        title = user_message[:30] + "..." if len(user_message) > 30 else user_message
+        message_id = self.store.append_message(self.owner, chat_id, title, user_message, ai_response, timestamp, ttft=ttft)
         
-        self.chats[chat_id]['messages'].append({
-            'user': user_message,
-            'ai': ai_response,
-            'timestamp': timestamp
-        })
+        # 增量更新搜尋索引
+        if self.store.get_chat(self.owner, chat_id)['message_count'] == 1:
+            self.index.add(('title', chat_id), title)
+        self.index.add(('user', message_id), user_message)
+        self.index.add(('ai', message_id), ai_response)
+    
+    def list_chats(self, limit=None, offset=0):
+        """對話清單（只含標題，不載入訊息）"""
+        return self.store.list_chats(self.owner, limit=limit, offset=offset)
+    
+    def count(self):
+        """回傳 (對話數, 訊息數)"""
+        return self.store.count(self.owner)
+    
+    def has_chat(self, chat_id):
+        return self.store.get_chat(self.owner, chat_id) is not None
     
-    def search_chats(self, keyword):
-        """搜尋對話記錄"""
+    def iter_messages(self):
+        return self.store.iter_messages(self.owner)
+    
+    @property
+    def index_ready(self):
+        return self.index.ready.is_set()
+    
+    @staticmethod
+    def build_index(store, owner, index=None):
+        """由儲存區建立對話搜尋索引（標題與每則訊息的問題、回應各為一份文件）"""
+        index = index if index is not None else SearchIndex()
+        for chat in store.list_chats(owner):
+            index.add(('title', chat['chat_id']), chat['title'])
+        for message in store.iter_messages(owner):
+            index.add(('user', message['id']), message['user'])
+            index.add(('ai', message['id']), message['ai'])
+        return index
+    
+    @classmethod
+    def build_index_async(cls, store, owner):
+        """立即回傳空索引，由背景執行緒從儲存區建立；完成前 index.ready 未設定"""
+        index = SearchIndex()
+        index.ready.clear()
+        
+        def build():
+            try:
+                cls.build_index(store, owner, index=index)
+            finally:
+                index.ready.set()
+        
+        threading.Thread(target=build, name="chat-index-build", daemon=True).start()
+        return index
+    
+    def search_chats(self, keyword, limit=10):
+        """搜尋對話記錄，依 BM25 相關度回傳前 limit 筆"""
+        hits = self.index.search(keyword, limit=limit)
+        messages = self.store.get_messages_by_ids({doc_id for (kind, doc_id), _ in hits if kind != 'title'})
+        
         results = []
-        keyword_lower = keyword.lower()
-        
-        for chat_id, chat_data in self.chats.items():
-            # 搜尋標題
-            if keyword_lower in chat_data['title'].lower():
-                results.append({
-                    'chat_id': chat_id,
-                    'title': chat_data['title'],
-                    'type': 'title',
-                    'content': chat_data['title'],
-                    'timestamp': chat_data['created_at']
-                })
-            
-            # 搜尋訊息內容
-            for i, message in enumerate(chat_data['messages']):
-                # 搜尋用戶訊息
-                if keyword_lower in message['user'].lower():
-                    results.append({
-                        'chat_id': chat_id,
-                        'title': chat_data['title'],
-                        'type': 'user_message',
-                        'content': message['user'],
-                        'ai_response': message['ai'],
-                        'timestamp': message['timestamp'],
-                        'message_index': i
-                    })
-                
-                # 搜尋AI回應
-                if keyword_lower in message['ai'].lower():
+        for (kind, doc_id), score in hits:
+            if kind == 'title':
+                chat = self.store.get_chat(self.owner, doc_id)
+                if chat:
                     results.append({
-                        'chat_id': chat_id,
-                        'title': chat_data['title'],
-                        'type': 'ai_message',
-                        'content': message['ai'],
-                        'user_message': message['user'],
-                        'timestamp': message['timestamp'],
-                        'message_index': i
+                        'chat_id': doc_id,
+                        'title': chat['title'],
+                        'type': 'title',
+                        'content': chat['title'],
+                        'timestamp': chat['created_at'],
+                        'score': score
                     })
-        
-        # 按時間排序，最新的在前
-        results.sort(key=lambda x: x['timestamp'], reverse=True)
+                continue
+            
+            message = messages.get(doc_id)
+            if message is None:
+                continue
+            result = {
+                'chat_id': message['chat_id'],
+                'title': message['title'],
+                'timestamp': message['timestamp'],
+                'message_index': message['message_index'],
+                'score': score
+            }
+            if kind == 'user':
+                result.update(type='user_message', content=message['user'], ai_response=message['ai'])
+            else:
+                result.update(type='ai_message', content=message['ai'], user_message=message['user'])
+            results.append(result)
         return results
     
     def highlight_keyword(self, text, keyword):
-        """高亮關鍵字"""
+        """高亮關鍵字（位置由索引的切詞方式計算）"""
         if not keyword:
             return text
         
-        # 使用正則表達式進行不區分大小寫的替換
-        pattern = re.compile(re.escape(keyword), re.IGNORECASE)
-        return pattern.sub(f'<span class="search-highlight">{keyword}</span>', text)
+        parts, last = [], 0
+        for start, end in self.index.highlight_spans(text, keyword):
+            parts.append(html.escape(text[last:start]))
+            parts.append(f'<span class="search-highlight">{html.escape(text[start:end])}</span>')
+            last = end
+        parts.append(html.escape(text[last:]))
+        return ''.join(parts)
     
-    def get_chat_history(self, chat_id):
-        """獲取特定對話的歷史記錄"""
-        return self.chats.get(chat_id, None)
+    def get_chat_history(self, chat_id, limit=None):
+        """獲取特定對話的歷史記錄；指定 limit 時只載入最近 limit 則訊息"""
+        chat = self.store.get_chat(self.owner, chat_id)
+        if chat is None:
+            return None
+        offset = max(0, chat['message_count'] - limit) if limit is not None else 0
+        chat['messages'] = self.store.get_messages(chat_id, offset=offset, limit=limit)
+        return chat
     
     def delete_chat(self, chat_id):
         """刪除對話"""
-        if chat_id in self.chats:
-            del self.chats[chat_id]
-            return True
-        return False
+        message_ids = self.store.message_ids(chat_id)
+        if not self.store.delete_chats(self.owner, [chat_id]):
+            return False
+        self.index.remove(('title', chat_id))
+        for message_id in message_ids:
+            self.index.remove(('user', message_id))
+            self.index.remove(('ai', message_id))
+        return True
+    
+    def clear_chats(self):
+        """刪除所有對話，回傳刪除數量"""
+        deleted = len(self.store.delete_chats(self.owner))
+        self.index.clear()
+        return deleted
+
+# 背景串流生成：逐段累積回應文字，記錄首字延遲，可隨時取消
+class StreamingReply:
+    def __init__(self, model, prompt, cached=None):
+        self.chunks = []
+        self.error = None
+        self.started_at = time.perf_counter()
+        self.first_token_at = None
+        self.finished_at = None
+        self.done = threading.Event()
+        self.cancelled = threading.Event()
+        self._lock = threading.Lock()
+        if cached is not None:
+            # 快取命中：不呼叫模型，直接視為已完成
+            self.chunks.append(cached)
+            self.first_token_at = self.finished_at = time.perf_counter()
+            self.done.set()
+            return
+        self._thread = threading.Thread(target=self._run, args=(model, prompt), name="gemini-stream", daemon=True)
+        self._thread.start()
+    
+    def _run(self, model, prompt):
+        stream = None
+        try:
+            stream = iter(model.generate_content(prompt, stream=True))
+            for chunk in stream:
+                if self.cancelled.is_set():
+                    break
+                try:
+                    text = chunk.text
+                except ValueError:
+                    # 被安全機制攔截等沒有文字的片段
+                    continue
+                with self._lock:
+                    # 取消後抵達的片段不再加入，頁面已以取消當下的文字收尾
+                    if self.cancelled.is_set():
+                        break
+                    if self.first_token_at is None and text:
+                        self.first_token_at = time.perf_counter()
+                    self.chunks.append(text)
+        except Exception as e:
+            self.error = e
+        finally:
+            # 提前結束時關閉串流，釋放底層連線
+            close = getattr(stream, 'close', None)
+            if close is not None:
+                try:
+                    close()
+                except Exception:
+                    pass
+            self.finished_at = self.finished_at or time.perf_counter()
+            self.done.set()
+    
+    def cancel(self):
+        """立即結束這次回應；背景串流在下一個片段抵達時關閉"""
+        with self._lock:
+            self.cancelled.set()
+            self.finished_at = self.finished_at or time.perf_counter()
+    
+    @property
+    def text(self):
+        with self._lock:
+            return ''.join(self.chunks)
+    
+    @property
+    def ttft(self):
+        """首字延遲（秒）"""
+        return self.first_token_at - self.started_at if self.first_token_at else None
+    
+    @property
+    def duration(self):
+        return (self.finished_at or time.perf_counter()) - self.started_at
+
+# 多輪對話脈絡：近期對話原文保留，較早的對話分段摺疊成滾動摘要（存於對話儲存區），總長度不超過 token 預算
+class ChatContextBuilder:
+    SUMMARY_PROMPT = """以下是一段對話的既有摘要與後續對話，請整合成一份新的繁體中文摘要，
+保留使用者的需求、偏好、重要事實與尚未解決的問題，不超過 {max_chars} 字。
+
+既有摘要：
+{summary}
+
+後續對話：
+{turns}
+"""
+    
+    def __init__(self, model, store, token_budget=3000, summary_tokens=400):
+        self.model = model
+        self.store = store
+        self.token_budget = token_budget
+        self.summary_tokens = summary_tokens
+        # 單次摘要請求最多摺疊的對話量，避免長對話一次送出整段歷史
+        self.chunk_tokens = max(token_budget, 1000)
+    
+    @staticmethod
+    def estimate_tokens(text):
+        """粗估 token 數：中日韓文字約一字一 token，其餘約四個字元一 token"""
+        cjk = sum(1 for char in text if '\u3000' <= char <= '\u9fff' or '\uac00' <= char <= '\ud7af' or '\uff00' <= char <= '\uffef')
+        return cjk + (len(text) - cjk + 3) // 4
+    
+    @classmethod
+    def _turn_tokens(cls, message):
+        return cls.estimate_tokens(message['user']) + cls.estimate_tokens(message['ai'])
+    
+    @staticmethod
+    def _question(user_input):
+        return f"請用繁體中文回答以下問題：{user_input}"
+    
+    def _summarize(self, summary, turns):
+        """把新摺疊的對話併入既有摘要；失敗時回傳 None"""
+        prompt = self.SUMMARY_PROMPT.format(
+            max_chars=self.summary_tokens,
+            summary=summary or '（無）',
+            turns='\n'.join(f"使用者：{message['user']}\nAI：{message['ai']}" for message in turns)
+        )
+        try:
+            text = self.model.generate_content(prompt).text.strip()
+        except Exception as e:
+            print(f"對話摘要錯誤: {e}")
+            return None
+        # 摘要本身也受預算限制
+        while text and self.estimate_tokens(text) > self.summary_tokens:
+            text = text[:int(len(text) * 0.9)]
+        return text
+    
+    def build(self, chat_id, user_input):
+        """回傳 generate_content 使用的多輪 contents；只讀取摘要之後的訊息"""
+        question = self._question(user_input)
+        # 問題本身超出預算時不保留任何原文對話
+        recent_budget = max(0, self.token_budget - self.summary_tokens - self.estimate_tokens(question))
+        summary = self.store.get_summary(chat_id)
+        messages = self.store.get_messages(chat_id, offset=summary['upto'])
+        tokens = [self._turn_tokens(message) for message in messages]
+        
+        # 原文只保留預算內最近的對話
+        window_start, used = len(messages), 0
+        while window_start > 0 and used + tokens[window_start - 1] <= recent_budget:
+            window_start -= 1
+            used += tokens[window_start]
+        
+        if messages and sum(tokens) > recent_budget:
+            # 超出預算時摺疊到只剩一半預算，之後幾輪都不必再摘要；
+            # 每次最多摺疊 chunk_tokens，積欠較多時（例如舊對話）分幾輪逐步補上
+            fold_end, remaining, folded = 0, sum(tokens), 0
+            while fold_end < len(messages) and remaining > recent_budget // 2:
+                if fold_end and folded + tokens[fold_end] > self.chunk_tokens:
+                    break
+                remaining -= tokens[fold_end]
+                folded += tokens[fold_end]
+                fold_end += 1
+            # 沒有新摺疊的對話時不重寫摘要；摘要失敗時不推進 upto，這些對話留待下一輪再摺疊
+            text = self._summarize(summary['text'], messages[:fold_end]) if fold_end else None
+            if text is not None:
+                summary = {'upto': summary['upto'] + fold_end, 'text': text}
+                self.store.save_summary(chat_id, summary['upto'], text)
+                window_start = max(window_start, fold_end)
+        
+        contents = []
+        if summary['text']:
+            contents.append({'role': 'user', 'parts': [f"（先前對話摘要）\n{summary['text']}"]})
+            contents.append({'role': 'model', 'parts': ["好的，我會參考先前的對話內容。"]})
+        for message in messages[window_start:]:
+            contents.append({'role': 'user', 'parts': [self._question(message['user'])]})
+            contents.append({'role': 'model', 'parts': [message['ai']]})
+        contents.append({'role': 'user', 'parts': [question]})
+        return contents
+
+# Gemini 回應快取（記憶體、跨會話共用）：正規化提示詞精確比對，單輪提問另以使用者問題的 MinHash 比對近似問題
+class ResponseCache:
+    # MinHash 簽章切成 BANDS 段、每段 ROWS 個值（LSH）；Jaccard 約 (1/BANDS)^(1/ROWS)≈0.59 以上的問題
+    # 很可能至少有一段相同而成為候選，候選再以實際 Jaccard 相似度確認
+    BANDS = 8
+    ROWS = 4
+    _PRIME = (1 << 61) - 1
+    
+    def __init__(self, max_entries=500, ttl=3600, near_duplicate=True, min_overlap=0.7):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.near_duplicate = near_duplicate
+        self.min_overlap = min_overlap  # 近似命中所需的詞彙 Jaccard 相似度
+        # MinHash 使用的雜湊排列 (a * x + b) mod p，固定種子讓結果可重現
+        rng = random.Random(20240601)
+        self._permutations = [
+            (rng.randrange(1, self._PRIME), rng.randrange(0, self._PRIME)) for _ in range(self.BANDS * self.ROWS)
+        ]
+        self._entries = OrderedDict()
+        self._bands = {}
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+        self.near_hits = 0
+        self.saved_seconds = 0.0
+    
+    @staticmethod
+    def normalize(text):
+        text = unicodedata.normalize('NFKC', text).lower()
+        text = re.sub(r'\s+', ' ', text)
+        # 中日文之間的空白不影響語意
+        text = re.sub(f'(?<=[{SearchIndex._CJK}]) | (?=[{SearchIndex._CJK}])', '', text)
+        return text.strip(' ?!.。？！～~')
+    
+    @classmethod
+    def _prompt_text(cls, prompt):
+        """把單一字串或多輪 contents 轉成正規化文字；回傳 (文字, 是否為單輪提問)"""
+        if isinstance(prompt, str):
+            return cls.normalize(prompt), True
+        turns = [f"{turn['role']}:{cls.normalize(' '.join(map(str, turn['parts'])))}" for turn in prompt]
+        return '\n'.join(turns), len(turns) == 1
+    
+    def minhash(self, terms):
+        """詞彙集合的 MinHash 簽章（BANDS * ROWS 個值）"""
+        values = [int.from_bytes(hashlib.blake2b(term.encode('utf-8'), digest_size=8).digest(), 'big') for term in terms]
+        return tuple(min((a * value + b) % self._PRIME for value in values) for a, b in self._permutations)
+    
+    def _band_keys(self, scope, signature):
+        return [(scope, band, signature[band * self.ROWS:(band + 1) * self.ROWS]) for band in range(self.BANDS)]
+    
+    def _lookup_key(self, prompt, model_name, generation_config, question):
+        """回傳 (精確比對鍵, 範圍, MinHash 簽章, 問題詞彙集合)
+        
+        近似比對只用使用者原始問題：包裝提示詞的固定前綴會蓋過短問題之間的差異。
+        """
+        text, single_turn = self._prompt_text(prompt)
+        scope = json.dumps([model_name, generation_config or {}], sort_keys=True, ensure_ascii=False)
+        key = hashlib.sha256(f"{scope}\n{text}".encode('utf-8')).hexdigest()
+        if not (self.near_duplicate and single_turn and question):
+            return key, scope, None, None
+        terms = frozenset(SearchIndex.tokenize(self.normalize(question)))
+        if not terms:
+            return key, scope, None, None
+        return key, scope, self.minhash(terms), terms
+    
+    def _drop(self, key):
+        entry = self._entries.pop(key)
+        if entry['signature'] is not None:
+            for band_key in self._band_keys(entry['scope'], entry['signature']):
+                keys = self._bands.get(band_key)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self._bands[band_key]
+    
+    def _find_near(self, scope, signature, terms, now):
+        candidates = set()
+        for band_key in self._band_keys(scope, signature):
+            candidates |= self._bands.get(band_key, set())
+        best = None
+        for key in candidates:
+            entry = self._entries[key]
+            if entry['expires_at'] <= now:
+                continue
+            overlap = len(terms & entry['terms']) / len(terms | entry['terms'])
+            if overlap >= self.min_overlap and (best is None or overlap > best[0]):
+                best = (overlap, key)
+        return best[1] if best else None
+    
+    def get(self, prompt, model_name, generation_config=None, question=None):
+        """回傳 (回應文字, 'exact' 或 'near')；未命中回傳 None
+        
+        question 為使用者原始問題，提供時才進行近似比對。
+        """
+        key, scope, signature, terms = self._lookup_key(prompt, model_name, generation_config, question)
+        now = time.time()
+        with self._lock:
+            self.lookups += 1
+            kind = 'exact'
+            entry = self._entries.get(key)
+            if entry is not None and entry['expires_at'] <= now:
+                self._drop(key)
+                entry = None
+            if entry is None and signature is not None:
+                key, kind = self._find_near(scope, signature, terms, now), 'near'
+                entry = self._entries.get(key) if key else None
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            self.near_hits += kind == 'near'
+            self.saved_seconds += entry['latency']
+            return entry['text'], kind
+    
+    def put(self, prompt, model_name, text, latency, generation_config=None, question=None, ttl=None):
+        """寫入回應；ttl=0 表示此筆不快取"""
+        ttl = self.ttl if ttl is None else ttl
+        if not ttl or not text:
+            return
+        key, scope, signature, terms = self._lookup_key(prompt, model_name, generation_config, question)
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = {
+                'text': text,
+                'latency': latency,
+                'scope': scope,
+                'signature': signature,
+                'terms': terms,
+                'expires_at': time.time() + ttl
+            }
+            if signature is not None:
+                for band_key in self._band_keys(scope, signature):
+                    self._bands.setdefault(band_key, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bands.clear()
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'lookups': self.lookups,
+                'hits': self.hits,
+                'near_hits': self.near_hits,
+                'hit_rate': self.hits / self.lookups if self.lookups else 0.0,
+                'saved_seconds': self.saved_seconds
+            }
+
+# 初始化Gemini
+GEMINI_MODEL = 'gemini-2.5-flash'
+
+@st.cache_resource
+def init_gemini():
+    try:
+        genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+        return genai.GenerativeModel(GEMINI_MODEL)
+    except Exception:
+        return None
+
+model = init_gemini()
+
+# 全程序共用的 HTTP 連線池
+@st.cache_resource
+def get_http_client():
+    return HttpClient()
+
+# 全程序共用的上游來源健康狀態（熔斷器）
+@st.cache_resource
+def get_source_health():
+    return SourceHealth()
+
+# 全程序共用的新聞文章庫
+@st.cache_resource
+def get_article_store():
+    return ArticleStore(os.path.join(DATA_DIR, 'news.db'))
+
+# 全程序共用的新聞搜尋索引（啟動時由文章庫建立，之後隨寫入增量更新）
+@st.cache_resource
+def get_news_index():
+    return NewsManager.build_index(get_article_store())
+
+# 全程序共用的新聞預先分析（啟動時補上尚未分析的文章）
+@st.cache_resource
+def get_news_pre_analyzer():
+    if not model:
+        return None
+    pre_analyzer = NewsPreAnalyzer(
+        model,
+        get_article_store(),
+        GEMINI_MODEL,
+        batch_size=int(os.environ.get("NEWS_ANALYSIS_BATCH_SIZE", 8)),
+        concurrency=int(os.environ.get("NEWS_ANALYSIS_CONCURRENCY", 2)),
+        daily_budget=int(os.environ.get("NEWS_ANALYSIS_DAILY_BUDGET", 40))
+    )
+    pre_analyzer.submit(get_article_store().pending_analysis(limit=pre_analyzer.batch_size * 2))
+    return pre_analyzer
+
+# 全程序共用的對話記錄儲存區
+@st.cache_resource
+def get_chat_store():
+    return ChatStore(os.path.join(DATA_DIR, 'chats.db'))
+
+# 各使用者的對話搜尋索引（同一使用者的多個會話共用，隨新增/刪除增量更新）
+# uid 來自網址，數量與效期都需設限；被淘汰後下次使用時再由儲存區重建（在背景建立，不阻塞頁面）
+@st.cache_resource(max_entries=64, ttl=6 * 3600)
+def get_chat_index(owner):
+    return ChatManager.build_index_async(get_chat_store(), owner)
+
+# 全程序共用的 AI 回應快取
+@st.cache_resource
+def get_response_cache():
+    return ResponseCache(
+        max_entries=int(os.environ.get("CHAT_CACHE_MAX_ENTRIES", 500)),
+        ttl=int(os.environ.get("CHAT_CACHE_TTL", 3600)),
+        near_duplicate=os.environ.get("CHAT_CACHE_NEAR_DUPLICATE", "true").lower() == "true"
+    )
+
+# 全程序共用的多輪對話脈絡（滾動摘要存於對話儲存區）
+@st.cache_resource
+def get_chat_context():
+    return ChatContextBuilder(
+        model,
+        get_chat_store(),
+        token_budget=int(os.environ.get("CHAT_CONTEXT_TOKEN_BUDGET", 3000))
+    )
+
+# 全程序共用的摘要擷取器（記憶結果跨會話共享）
+@st.cache_resource
+def get_summary_extractor():
+    return SummaryExtractor(parser='regex')
+
+# 全程序共用的新聞服務：背景輪詢更新，各會話只讀取文章庫
+@st.cache_resource
+def get_news_manager():
+    news_manager = NewsManager(
+        http=get_http_client(),
+        store=get_article_store(),
+        summarizer=get_summary_extractor(),
+        index=get_news_index(),
+        pre_analyzer=get_news_pre_analyzer(),
+        health=get_source_health(),
+        newsapi_daily_budget=int(os.environ.get("NEWSAPI_DAILY_BUDGET", 90))
+    )
+    news_manager.start_poller()
+    return news_manager
+
+# 美股交易日曆
+@st.cache_resource
+def get_market_calendar():
+    return MarketCalendar()
+
+# 全程序共用的報價快取（所有會話共享）
+@st.cache_resource
+def get_quote_cache():
+    return QuoteCache(ttl=300, ttl_func=get_market_calendar().symbol_quote_ttl)
+
+@st.cache_resource
+def get_metadata_cache():
+    return QuoteCache(ttl=86400)
+
+@st.cache_resource
+def get_history_store():
+    return HistoryStore(os.path.join(DATA_DIR, 'history.db'))
+
+@st.cache_resource
+def get_symbol_resolver():
+    return SymbolResolver.from_csv(os.path.join(APP_DIR, 'data', 'symbols.csv'))
+
+@st.cache_resource
+def get_portfolio_analyzer():
+    manager = StockDataManager(
+        cache=get_quote_cache(),
+        metadata_cache=get_metadata_cache(),
+        history_store=get_history_store(),
+        health=get_source_health()
+    )
+    return PortfolioAnalyzer(manager)
+
+@st.cache_resource
+def get_quote_refresher():
+    manager = StockDataManager(
+        cache=get_quote_cache(),
+        metadata_cache=get_metadata_cache(),
+        history_store=get_history_store(),
+        health=get_source_health()
+    )
+    refresher = QuoteRefresher(
+        get_quote_cache(),
+        manager._fetch_batch,
+        metadata_cache=get_metadata_cache(),
+        metadata_func=manager._fetch_metadata
+    )
+    refresher.start()
+    return refresher
 
 # 初始化
 if "stock_manager" not in st.session_state:
-    st.session_state.stock_manager = StockDataManager()
+    st.session_state.stock_manager = StockDataManager(
+        cache=get_quote_cache(),
+        metadata_cache=get_metadata_cache(),
+        history_store=get_history_store(),
+        health=get_source_health()
+    )
 
 if "news_manager" not in st.session_state:
-    st.session_state.news_manager = NewsManager()
+    st.session_state.news_manager = get_news_manager()
+
+# 以網址參數識別使用者，重新整理頁面後仍能讀回自己的對話記錄
+# 注意：uid 是唯一的憑證，取得含 uid 的網址即可讀取該使用者的對話（對話頁面會提示）
+if "user_id" not in st.session_state:
+    st.session_state.user_id = st.query_params.get("uid") or uuid.uuid4().hex
+    st.query_params["uid"] = st.session_state.user_id
 
 if "chat_manager" not in st.session_state:
-    st.session_state.chat_manager = ChatManager()
+    st.session_state.chat_manager = ChatManager(
+        store=get_chat_store(),
+        owner=st.session_state.user_id,
+        index=get_chat_index(st.session_state.user_id)
+    )
+else:
+    # 索引可能已被淘汰重建，每次重繪都取用目前快取中的索引
+    st.session_state.chat_manager.index = get_chat_index(st.session_state.user_id)
 
 if "current_page" not in st.session_state:
     st.session_state.current_page = "主頁"
@@ -494,16 +3119,42 @@ if "watched_stocks" not in st.session_state:
 if "current_chat_id" not in st.session_state:
     st.session_state.current_chat_id = None
 
-# 初始化Gemini
+if "pending_reply" not in st.session_state:
+    st.session_state.pending_reply = None
+
+if "history_limit" not in st.session_state:
+    st.session_state.history_limit = 20
+
+if "session_id" not in st.session_state:
+    st.session_state.session_id = str(uuid.uuid4())
+
+# 讓背景更新程序知道本會話關注的股票
+get_quote_refresher().watch(st.session_state.session_id, st.session_state.watched_stocks)
+
+NEWS_ANALYSIS_PROMPT = """請分析這則新聞並用繁體中文回答：
+標題：{title}
+摘要：{summary}
+
+請提供：
+1. 新聞重點摘要
+2. 對科技產業的影響
+3. 未來發展預測
+"""
+
 @st.cache_resource
-def init_gemini():
-    try:
-        genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
-        return genai.GenerativeModel('gemini-2.5-flash')
-    except Exception:
-        return None
+def get_analysis_cache():
+    return AnalysisCache(os.path.join(DATA_DIR, 'analysis_cache.db'))
 
-model = init_gemini()
+def analyze_news(news):
+    """AI解讀新聞；相同標題、摘要、提示詞與模型的分析結果跨會話共用"""
+    cache = get_analysis_cache()
+    key = AnalysisCache.make_key(news['title'], news['summary'], NEWS_ANALYSIS_PROMPT, GEMINI_MODEL)
+    analysis = cache.get(key)
+    if analysis is None:
+        response = model.generate_content(NEWS_ANALYSIS_PROMPT.format(title=news['title'], summary=news['summary']))
+        analysis = response.text
+        cache.put(key, analysis)
+    return analysis
 
 # 側邊欄
 with st.sidebar:
@@ -608,7 +3259,7 @@ if st.session_state.current_page == "主頁":
         """, unsafe_allow_html=True)
     
     with col3:
-        chat_count = len(st.session_state.chat_manager.chats)
+        chat_count, _ = st.session_state.chat_manager.count()
         st.markdown(f"""
         <div class="metric-card">
             <h4>💬 對話記錄</h4>
@@ -652,13 +3303,15 @@ elif st.session_state.current_page == "對話":
         
         with col2:
             if st.button("🔍 搜尋", key="search_chat"):
-                if search_keyword.strip():
-                    search_results = st.session_state.chat_manager.search_chats(search_keyword.strip())
+                if not st.session_state.chat_manager.index_ready:
+                    st.info("🔄 對話索引建立中，請稍候再搜尋")
+                elif search_keyword.strip():
+                    search_results = st.session_state.chat_manager.search_chats(search_keyword.strip(), limit=10)
                     
                     if search_results:
                         st.markdown(f"### 🎯 搜尋結果 ({len(search_results)} 筆)")
                         
-                        for result in search_results[:10]:  # 限制顯示前10筆結果
+                        for rank, result in enumerate(search_results):
                             with st.expander(f"📝 {result['title']} - {result['timestamp'].strftime('%Y-%m-%d %H:%M')}"):
                                 if result['type'] == 'user_message':
                                     st.markdown("**👤 你的問題：**")
@@ -678,14 +3331,33 @@ elif st.session_state.current_page == "對話":
                                     st.markdown(highlighted_content, unsafe_allow_html=True)
                                 
                                 # 載入完整對話按鈕
-                                if st.button(f"📖 查看完整對話", key=f"load_chat_{result['chat_id']}"):
+                                if st.button(f"📖 查看完整對話", key=f"load_chat_{rank}_{result['chat_id']}"):
                                     st.session_state.current_chat_id = result['chat_id']
+                                    st.session_state.history_limit = 20
                                     st.rerun()
                     else:
                         st.info("沒有找到相關的對話記錄")
                 else:
                     st.warning("請輸入搜尋關鍵字")
         
+        # 已儲存的對話清單（只讀取標題，分頁載入）
+        st.caption("🔒 對話記錄以網址中的 uid 識別，任何取得此網址的人都能看到你的對話；分享網址前請先移除 uid 參數")
+        chat_count, _ = st.session_state.chat_manager.count()
+        if chat_count:
+            with st.expander(f"📚 我的對話（{chat_count}）"):
+                chat_pages = max(1, -(-chat_count // 10))
+                chat_page = st.number_input("頁數", min_value=1, max_value=chat_pages, step=1, key="chat_list_page") if chat_pages > 1 else 1
+                for chat in st.session_state.chat_manager.list_chats(limit=10, offset=(chat_page - 1) * 10):
+                    label = f"{'▶️ ' if chat['chat_id'] == st.session_state.current_chat_id else ''}{chat['title']}"
+                    col1, col2 = st.columns([4, 1])
+                    with col1:
+                        if st.button(label, key=f"open_chat_{chat['chat_id']}", use_container_width=True):
+                            st.session_state.current_chat_id = chat['chat_id']
+                            st.session_state.history_limit = 20
+                            st.rerun()
+                    with col2:
+                        st.caption(f"{chat['message_count']} 則 · {chat['created_at'].strftime('%m/%d')}")
+        
         st.markdown("---")
         
         # 新對話區域
@@ -694,50 +3366,106 @@ elif st.session_state.current_page == "對話":
         
         # 對話介面
         user_input = st.text_area("輸入你的問題：", height=100, key="chat_input")
+        use_cache = st.checkbox("⚡ 使用回應快取", value=True, key="use_response_cache",
+                                help="相同或相似的問題直接回覆先前的答案；取消勾選則重新生成且不寫入快取")
         
+        pending = st.session_state.pending_reply
         col1, col2, col3 = st.columns([1, 1, 3])
         with col1:
-            if st.button("💬 發送", key="send_msg", type="primary"):
+            if st.button("💬 發送", key="send_msg", type="primary", disabled=pending is not None):
                 if user_input.strip():
-                    try:
-                        with st.spinner("🤔 AI正在思考..."):
-                            prompt = f"請用繁體中文回答以下問題：{user_input}"
-                            response = model.generate_content(prompt)
-                            
-                            # 生成對話ID
-                            if st.session_state.current_chat_id is None:
-                                st.session_state.current_chat_id = str(uuid.uuid4())
-                            
-                            # 儲存對話記錄
-                            st.session_state.chat_manager.add_message(
-                                st.session_state.current_chat_id,
-                                user_input,
-                                response.text
-                            )
-                            
-                            st.markdown("---")
-                            st.markdown("**👤 你的問題：**")
-                            st.write(user_input)
-                            
-                            st.markdown("**🤖 AI回應：**")
-                            st.write(response.text)
-                            
-                    except Exception as e:
-                        st.error(f"AI回應錯誤：{str(e)}")
+                    # 生成對話ID
+                    if st.session_state.current_chat_id is None:
+                        st.session_state.current_chat_id = str(uuid.uuid4())
+                    
+                    # 帶入先前對話（受 token 預算限制，較早的內容以摘要代替）
+                    with st.spinner("整理對話脈絡..."):
+                        prompt = get_chat_context().build(st.session_state.current_chat_id, user_input)
+                    
+                    # 先查回應快取，未命中才在背景串流生成，頁面逐段顯示
+                    cache_hit = get_response_cache().get(prompt, GEMINI_MODEL, question=user_input) if use_cache else None
+                    pending = st.session_state.pending_reply = {
+                        'chat_id': st.session_state.current_chat_id,
+                        'user': user_input,
+                        'prompt': prompt,
+                        'use_cache': use_cache,
+                        'cache_hit': cache_hit[1] if cache_hit else None,
+                        'reply': StreamingReply(model, prompt, cached=cache_hit[0] if cache_hit else None)
+                    }
                 else:
                     st.warning("請輸入問題後再發送")
         
         with col2:
-            if st.button("🔄 新對話", key="new_chat"):
+            if pending is not None:
+                # 按下按鈕會中斷目前的重繪，下一輪重繪再通知背景生成停止
+                if st.button("⏹️ 停止生成", key="cancel_reply"):
+                    pending['reply'].cancel()
+            elif st.button("🔄 新對話", key="new_chat"):
                 st.session_state.current_chat_id = None
+                st.session_state.history_limit = 20
                 st.rerun()
         
+        if pending is not None:
+            reply = pending['reply']
+            st.markdown("---")
+            st.markdown("**👤 你的問題：**")
+            st.write(pending['user'])
+            
+            st.markdown("**🤖 AI回應：**")
+            placeholder = st.empty()
+            if not reply.text:
+                placeholder.caption("🤔 AI正在思考...")
+            # 按下停止後立即收尾，不必等背景串流收到下一個片段
+            while not reply.done.wait(0.1) and not reply.cancelled.is_set():
+                if reply.text:
+                    placeholder.markdown(reply.text + " ▌")
+            
+            st.session_state.pending_reply = None
+            if reply.cancelled.is_set() and not reply.text:
+                placeholder.info("已停止生成")
+            elif reply.error is not None and not reply.text:
+                placeholder.empty()
+                st.error(f"AI回應錯誤：{str(reply.error)}")
+            else:
+                ai_response = reply.text
+                if reply.cancelled.is_set():
+                    ai_response += "\n\n（已停止生成）"
+                elif reply.error is not None:
+                    ai_response += "\n\n（回應中斷）"
+                placeholder.markdown(ai_response)
+                
+                # 串流結束後以完整文字儲存對話記錄
+                st.session_state.chat_manager.add_message(
+                    pending['chat_id'],
+                    pending['user'],
+                    ai_response,
+                    ttft=reply.ttft
+                )
+                if pending['cache_hit']:
+                    st.caption("⚡ 快取回應（" + ("相同問題" if pending['cache_hit'] == 'exact' else "相似問題") + "）")
+                else:
+                    if pending['use_cache'] and not reply.cancelled.is_set() and reply.error is None:
+                        get_response_cache().put(pending['prompt'], GEMINI_MODEL, ai_response, reply.duration,
+                                                 question=pending['user'])
+                    ttft_text = f"{reply.ttft:.2f} 秒" if reply.ttft is not None else "—"
+                    st.caption(f"⚡ 首字延遲 {ttft_text} · 總耗時 {reply.duration:.2f} 秒")
+        
         # 顯示當前對話歷史
-        if st.session_state.current_chat_id and st.session_state.current_chat_id in st.session_state.chat_manager.chats:
+        chat_history = None
+        if st.session_state.current_chat_id:
+            # 只載入最近的訊息，較早的訊息按需要再載入
+            chat_history = st.session_state.chat_manager.get_chat_history(
+                st.session_state.current_chat_id,
+                limit=st.session_state.history_limit
+            )
+        if chat_history:
             st.markdown("---")
             st.markdown("### 💬 當前對話記錄")
             
-            chat_history = st.session_state.chat_manager.get_chat_history(st.session_state.current_chat_id)
+            if chat_history['message_count'] > len(chat_history['messages']):
+                if st.button(f"⬆️ 載入更早的訊息（還有 {chat_history['message_count'] - len(chat_history['messages'])} 則）", key="load_older"):
+                    st.session_state.history_limit += 20
+                    st.rerun()
             
             for i, message in enumerate(chat_history['messages']):
                 with st.container():
@@ -755,18 +3483,46 @@ elif st.session_state.current_page == "股市":
     # 股票輸入
     col1, col2 = st.columns([3, 1])
     with col1:
-        new_stock = st.text_input("輸入股票代碼", placeholder="例如: AAPL, TSLA, GOOGL", key="stock_input")
+        new_stock = st.text_input("輸入股票代碼或公司名稱", placeholder="例如: AAPL、nvidia、台積電、蘋果", key="stock_input")
+        
+        # 中英文名稱比對股票代碼（本地索引，不需連網）
+        selected_stock = new_stock.strip().upper()
+        if selected_stock:
+            matches = get_symbol_resolver().resolve(new_stock)
+            match_names = {match['symbol']: match['name'] for match in matches}
+            if re.fullmatch(r"[A-Z0-9.^=-]{1,12}", selected_stock) and selected_stock not in match_names:
+                match_names[selected_stock] = "直接使用代碼"
+            if match_names:
+                selected_stock = st.selectbox(
+                    "符合的股票",
+                    list(match_names),
+                    format_func=lambda symbol: f"{symbol} — {match_names[symbol]}",
+                    key="stock_match"
+                )
     with col2:
         if st.button("➕ 添加", key="add_stock"):
-            if new_stock and new_stock.upper() not in st.session_state.watched_stocks:
-                st.session_state.watched_stocks.append(new_stock.upper())
-                st.success(f"已添加 {new_stock.upper()}")
-                st.rerun()
+            if selected_stock and selected_stock not in st.session_state.watched_stocks:
+                # 添加前先驗證一次代碼，避免無效代碼每次重繪都重新查詢
+                is_valid, error_kind = st.session_state.stock_manager.validate_symbol(selected_stock)
+                if is_valid:
+                    st.session_state.watched_stocks.append(selected_stock)
+                    st.success(f"已添加 {selected_stock}")
+                    st.rerun()
+                elif error_kind == 'network':
+                    st.warning("暫時無法連線到報價來源，請稍後再試")
+                else:
+                    st.error(f"找不到股票代碼 {selected_stock}")
     
     # 顯示關注的股票
     if st.session_state.watched_stocks:
         st.markdown("### 💼 我的關注股票")
         
+        # 一次批次取得所有關注股票的報價
+        try:
+            quotes = st.session_state.stock_manager.get_many(st.session_state.watched_stocks, allow_stale=True)
+        except Exception:
+            quotes = {}
+        
         for i, stock in enumerate(st.session_state.watched_stocks):
             col1, col2, col3, col4 = st.columns([2, 2, 2, 1])
             
@@ -775,9 +3531,13 @@ elif st.session_state.current_page == "股市":
             
             with col2:
                 try:
-                    stock_data = st.session_state.stock_manager.get_stock_data(stock)
+                    stock_data = quotes.get(stock)
                     if stock_data:
                         st.write(f"${stock_data['price']}")
+                        if stock_data.get('stale'):
+                            st.caption(f"⏳ {stock_data['age']}秒前的資料，更新中")
+                    elif st.session_state.stock_manager.cache.failure(stock):
+                        st.write("暫無報價")
                     else:
                         st.write("載入中...")
                 except Exception:
@@ -796,6 +3556,21 @@ elif st.session_state.current_page == "股市":
                 if st.button("❌", key=f"remove_{i}"):
                     st.session_state.watched_stocks.remove(stock)
                     st.rerun()
+        
+        # 歷史走勢（讀取本地K線儲存）
+        st.markdown("### 📈 歷史走勢")
+        chart_symbol = st.selectbox("選擇股票", st.session_state.watched_stocks, key="history_symbol")
+        try:
+            history = st.session_state.stock_manager.get_history(
+                chart_symbol,
+                start=get_taiwan_time().date() - timedelta(days=180)
+            )
+            if not history.empty:
+                st.line_chart(history['Close'])
+            else:
+                st.info("暫無歷史資料")
+        except Exception:
+            st.write("無法載入歷史資料")
     else:
         st.info("還沒有關注的股票，請添加一些股票開始追蹤")
 
@@ -809,14 +3584,15 @@ elif st.session_state.current_page == "新知":
         st.metric("NewsAPI", newsapi_status)
     
     with col2:
-        st.metric("RSS來源", "🟢 5個")
+        st.metric("RSS來源", f"🟢 {len(st.session_state.news_manager.rss_feeds)}個")
     
     with col3:
         if st.button("🔄 重新整理新聞", key="refresh_news"):
-            # 強制重新取得新聞
-            news_list = st.session_state.news_manager.get_news(force_refresh=True)
-            st.success("新聞已更新！")
-            st.rerun()
+            # 所有會話共用同一次更新，且有頻率限制
+            if st.session_state.news_manager.request_refresh() is None:
+                st.info("新聞剛更新過，請稍後再試")
+            else:
+                st.rerun()
     
     # 如果沒有NewsAPI，顯示設定說明
     if not news_api_key:
@@ -834,9 +3610,12 @@ elif st.session_state.current_page == "新知":
             **注意：** 免費版每日有100次請求限制，足夠一般使用
             """)
     
-    # 載入新聞
+    # 載入新聞（分頁讀取文章庫）
     with st.spinner("📰 載入最新新聞..."):
-        news_list = st.session_state.news_manager.get_news()
+        total_pages = st.session_state.news_manager.total_pages()
+        if st.session_state.get("news_page", 1) > total_pages:
+            st.session_state.news_page = total_pages
+        news_list = st.session_state.news_manager.get_news(page=st.session_state.get("news_page", 1) - 1)
     
     if news_list:
         st.markdown("### 🔥 最新科技新聞")
@@ -844,18 +3623,21 @@ elif st.session_state.current_page == "新知":
         # 新聞篩選
         col1, col2 = st.columns([2, 1])
         with col1:
-            search_news = st.text_input("🔍 搜尋新聞", placeholder="輸入關鍵字篩選新聞", key="news_search")
+            search_news = st.text_input("🔍 搜尋新聞", placeholder="多個關鍵字同時符合，以 OR 分隔任一符合，例如：GPT 晶片 OR 機器學習", key="news_search")
+        with col2:
+            st.number_input(f"頁數（共 {total_pages} 頁）", min_value=1, max_value=total_pages, key="news_page")
         
-        # 篩選新聞
+        # 搜尋新聞（倒排索引，依相關度排序）
         filtered_news = news_list
-        if search_news:
-            filtered_news = [
-                news for news in news_list 
-                if search_news.lower() in news['title'].lower() or 
-                   search_news.lower() in news['summary'].lower()
-            ]
+        if search_news.strip():
+            filtered_news = st.session_state.news_manager.search(search_news)
         
         if filtered_news:
+            # 背景預先完成的 AI 分析
+            pre_analyses = st.session_state.news_manager.store.get_analyses(
+                [news['id'] for news in filtered_news if news.get('id')]
+            )
+            
             for i, news in enumerate(filtered_news):
                 with st.container():
                     st.markdown(f"""
@@ -864,11 +3646,18 @@ elif st.session_state.current_page == "新知":
                         <p>{news['summary']}</p>
                         <div style="margin-top: 10px;">
                             <span class="news-source">📡 {news['source']}</span>
-                            <span class="news-time" style="margin-left: 20px;">⏰ {news['published']}</span>
+                            <span class="news-time" style="margin-left: 20px;">⏰ {format_relative_time(news.get('published_at'))}</span>
                         </div>
                     </div>
                     """, unsafe_allow_html=True)
                     
+                    pre_analysis = pre_analyses.get(news.get('id'))
+                    if pre_analysis:
+                        with st.expander("🧠 AI重點速覽"):
+                            st.markdown(f"**📌 新聞重點：** {pre_analysis['key_points']}")
+                            st.markdown(f"**🏭 產業影響：** {pre_analysis['industry_impact']}")
+                            st.markdown(f"**🔮 未來展望：** {pre_analysis['outlook']}")
+                    
                     col1, col2, col3 = st.columns(3)
                     with col1:
                         if news['link'] != '#':
@@ -881,20 +3670,10 @@ elif st.session_state.current_page == "新知":
                             if model:
                                 try:
                                     with st.spinner("🤔 AI分析中..."):
-                                        analysis_prompt = f"""請分析這則新聞並用繁體中文回答：
-                                        標題：{news['title']}
-                                        摘要：{news['summary']}
-                                        
-                                        請提供：
-                                        1. 新聞重點摘要
-                                        2. 對科技產業的影響
-                                        3. 未來發展預測
-                                        """
-                                        
-                                        response = model.generate_content(analysis_prompt)
+                                        analysis = analyze_news(news)
                                         
                                         with st.expander("🤖 AI深度分析", expanded=True):
-                                            st.write(response.text)
+                                            st.write(analysis)
                                 except Exception as e:
                                     st.error(f"分析失敗：{e}")
                             else:
@@ -917,26 +3696,32 @@ elif st.session_state.current_page == "推薦":
     # 基於用戶活動的個人化推薦
     st.markdown("### 📊 個人化分析")
     
+    # 簡單的關鍵字分析：逐批走過對話記錄一次，邊走邊計數，不把全部訊息載入記憶體
+    tech_keywords = ['python', 'ai', '程式', '開發', '學習', '技術']
+    finance_keywords = ['股票', '投資', '金融', '市場', '經濟']
+    topic_keywords = {
+        'dev': ['python', '程式', '開發'],
+        'finance': ['股票', '投資', '金融'],
+        'ai': ['ai', '人工智慧', '機器學習'],
+    }
+    chat_count, _ = st.session_state.chat_manager.count()
+    tech_count = finance_count = 0
+    topics = set()
+    if chat_count > 0:
+        for message in st.session_state.chat_manager.iter_messages():
+            text = message['user'].lower()
+            tech_count += sum(1 for keyword in tech_keywords if keyword in text)
+            finance_count += sum(1 for keyword in finance_keywords if keyword in text)
+            topics.update(topic for topic, keywords in topic_keywords.items()
+                          if topic not in topics and any(keyword in text for keyword in keywords))
+    
     col1, col2, col3 = st.columns(3)
     
     with col1:
-        chat_count = len(st.session_state.chat_manager.chats)
         st.metric("對話次數", chat_count)
         
         if chat_count > 0:
             # 分析最常討論的主題
-            all_messages = []
-            for chat in st.session_state.chat_manager.chats.values():
-                for message in chat['messages']:
-                    all_messages.append(message['user'])
-            
-            # 簡單的關鍵字分析
-            tech_keywords = ['Python', 'AI', '程式', '開發', '學習', '技術']
-            finance_keywords = ['股票', '投資', '金融', '市場', '經濟']
-            
-            tech_count = sum(1 for msg in all_messages for keyword in tech_keywords if keyword.lower() in msg.lower())
-            finance_count = sum(1 for msg in all_messages for keyword in finance_keywords if keyword.lower() in msg.lower())
-            
             if tech_count > finance_count:
                 st.success("🔧 你偏好技術類話題")
             elif finance_count > tech_count:
@@ -993,24 +3778,19 @@ elif st.session_state.current_page == "推薦":
         st.markdown("#### 💡 基於你的興趣推薦")
         
         # 基於對話記錄的智能推薦
-        if len(st.session_state.chat_manager.chats) > 0:
+        if chat_count > 0:
             recommendations = []
             
             # 分析對話內容給出推薦
-            all_text = ""
-            for chat in st.session_state.chat_manager.chats.values():
-                for message in chat['messages']:
-                    all_text += message['user'] + " "
-            
-            if any(keyword in all_text.lower() for keyword in ['python', '程式', '開發']):
+            if 'dev' in topics:
                 recommendations.append("🐍 Python進階技巧")
                 recommendations.append("🔧 開發工具使用")
             
-            if any(keyword in all_text.lower() for keyword in ['股票', '投資', '金融']):
+            if 'finance' in topics:
                 recommendations.append("📈 量化投資策略")
                 recommendations.append("💰 財務分析方法")
             
-            if any(keyword in all_text.lower() for keyword in ['ai', '人工智慧', '機器學習']):
+            if 'ai' in topics:
                 recommendations.append("🤖 深度學習框架")
                 recommendations.append("🧠 AI模型部署")
             
@@ -1064,6 +3844,30 @@ elif st.session_state.current_page == "推薦":
                 st.write("• 醫療類股 (JNJ, UNH)")
             if len(user_tech) < 3:
                 st.write("• 更多科技股 (META, AMZN)")
+        
+        # 以歷史K線計算的投資組合分析
+        st.markdown("#### 📈 投資組合分析（近一年，等權重）")
+        try:
+            with st.spinner("計算投資組合指標..."):
+                analysis = get_portfolio_analyzer().analyze(st.session_state.watched_stocks)
+            
+            portfolio = analysis['portfolio']
+            col1, col2, col3, col4 = st.columns(4)
+            with col1:
+                st.metric("組合報酬率", f"{portfolio['total_return']:.2f}%")
+            with col2:
+                st.metric("年化波動率", f"{portfolio['volatility']:.2f}%")
+            with col3:
+                st.metric("最大回撤", f"{portfolio['max_drawdown']:.2f}%")
+            with col4:
+                st.metric("Beta (SPY)", f"{portfolio['beta']:.2f}")
+            
+            st.dataframe(analysis['metrics'], use_container_width=True)
+            
+            with st.expander("🔗 相關係數矩陣"):
+                st.dataframe(analysis['correlation'], use_container_width=True)
+        except Exception as e:
+            st.warning(f"無法計算投資組合指標：{e}")
     else:
         st.info("開始添加關注股票來獲得投資建議")
 
@@ -1140,8 +3944,7 @@ elif st.session_state.current_page == "設定":
     
     with col1:
         if st.button("🗑️ 清除對話記錄", key="clear_chats"):
-            if st.session_state.chat_manager.chats:
-                st.session_state.chat_manager.chats.clear()
+            if st.session_state.chat_manager.clear_chats():
                 st.session_state.current_chat_id = None
                 st.success("對話記錄已清除")
                 st.rerun()
@@ -1155,10 +3958,73 @@ elif st.session_state.current_page == "設定":
             st.rerun()
     
     with col3:
-        if st.button("🔄 清除所有快取", key="clear_cache"):
-            st.session_state.stock_manager.cache.clear()
-            st.session_state.news_manager.cache.clear()
-            st.success("快取已清除")
+        # 報價、新聞與AI回應快取為所有使用者共用，會自動更新，這裡只清除本次連線的瀏覽狀態
+        if st.button("🔄 清除本次暫存", key="clear_cache", help="重設本次連線的分頁、搜尋與輸入狀態"):
+            for key in ("news_page", "news_search", "search_input", "stock_input", "stock_match", "history_symbol", "chat_list_page"):
+                st.session_state.pop(key, None)
+            st.session_state.history_limit = 20
+            st.rerun()
+    
+    # 上游來源健康狀態
+    st.markdown("### 🩺 資料來源狀態")
+    health_rows = get_source_health().snapshot()
+    if health_rows:
+        state_labels = {
+            CircuitBreaker.CLOSED: "🟢 正常",
+            CircuitBreaker.HALF_OPEN: "🟡 探測中",
+            CircuitBreaker.OPEN: "🔴 暫停"
+        }
+        st.dataframe(pd.DataFrame([
+            {
+                '來源': row['name'],
+                '狀態': state_labels[row['state']],
+                '近期呼叫': row['calls'],
+                '錯誤率': f"{row['error_rate']:.0%}",
+                '平均延遲(ms)': round(row['avg_latency'] * 1000) if row['avg_latency'] is not None else None,
+                'P95延遲(ms)': round(row['p95_latency'] * 1000) if row['p95_latency'] is not None else None,
+                '下次探測(秒)': round(row['retry_in']) if row['retry_in'] is not None else None,
+                '最近錯誤': f"{format_relative_time(row['last_error_at'])}：{row['last_error']}" if row['last_error_at'] else ''
+            }
+            for row in health_rows
+        ]).set_index('來源'), use_container_width=True)
+    else:
+        st.info("尚未呼叫任何資料來源")
+    
+    # AI 回應快取
+    st.markdown("### ⚡ AI回應快取")
+    cache_stats = get_response_cache().stats()
+    col1, col2, col3, col4 = st.columns(4)
+    with col1:
+        st.metric("命中率", f"{cache_stats['hit_rate']:.0%}")
+    with col2:
+        st.metric("命中次數", cache_stats['hits'], help=f"其中相似問題命中 {cache_stats['near_hits']} 次")
+    with col3:
+        st.metric("節省時間", f"{cache_stats['saved_seconds']:.1f} 秒")
+    with col4:
+        st.metric("快取筆數", cache_stats['entries'])
+    
+    # 報價效能測試
+    with st.expander("⏱️ 報價延遲測試"):
+        st.caption("以關注股票比較完整模式（含 Ticker.info）與目前使用的批次模式（本地K線增量同步）的延遲")
+        if st.button("▶️ 開始測試", key="benchmark_quotes"):
+            if st.session_state.watched_stocks:
+                with st.spinner("測試中..."):
+                    rows = st.session_state.stock_manager.benchmark_quote_fetch(st.session_state.watched_stocks)
+                benchmark_df = pd.DataFrame(rows).set_index('symbol')
+                st.dataframe(benchmark_df, use_container_width=True)
+                st.write(f"平均：完整模式 {benchmark_df['完整模式(ms)'].mean():.0f} ms，批次模式 {benchmark_df['批次模式(ms)'].mean():.0f} ms")
+            else:
+                st.info("沒有關注的股票可測試")
+    
+    with st.expander("⏱️ 摘要解析效能測試"):
+        corpus = list(st.session_state.news_manager.corpus)
+        st.caption(f"以最近錄製的 {len(corpus)} 篇 RSS 摘要比較各解析器")
+        if st.button("▶️ 開始測試", key="benchmark_summaries"):
+            if corpus:
+                rows = st.session_state.news_manager.summarizer.benchmark(corpus)
+                st.dataframe(pd.DataFrame(rows).set_index('解析器'), use_container_width=True)
+            else:
+                st.info("尚未錄製任何摘要，請先到 AI新知 頁面載入新聞")
     
     # 匯出功能
     st.markdown("### 📤 數據匯出")
@@ -1167,15 +4033,16 @@ elif st.session_state.current_page == "設定":
     
     with col1:
         if st.button("📁 匯出對話記錄", key="export_chats"):
-            if st.session_state.chat_manager.chats:
+            chats = st.session_state.chat_manager.list_chats()
+            if chats:
                 export_data = {
                     'export_time': get_taiwan_time().isoformat(),
-                    'total_chats': len(st.session_state.chat_manager.chats),
+                    'total_chats': len(chats),
                     'chats': {}
                 }
                 
-                for chat_id, chat_data in st.session_state.chat_manager.chats.items():
-                    export_data['chats'][chat_id] = {
+                for chat_data in chats:
+                    export_data['chats'][chat_data['chat_id']] = {
                         'title': chat_data['title'],
                         'created_at': chat_data['created_at'].isoformat(),
                         'messages': [
@@ -1184,7 +4051,7 @@ elif st.session_state.current_page == "設定":
                                 'ai': msg['ai'],
                                 'timestamp': msg['timestamp'].isoformat()
                             }
-                            for msg in chat_data['messages']
+                            for msg in st.session_state.chat_manager.store.get_messages(chat_data['chat_id'])
                         ]
                     }
                 
@@ -1215,10 +4082,10 @@ elif st.session_state.current_page == "設定":
     st.markdown("### 📊 系統統計")
     col1, col2, col3, col4 = st.columns(4)
     
+    chat_count, total_messages = st.session_state.chat_manager.count()
     with col1:
-        st.metric("對話總數", len(st.session_state.chat_manager.chats))
+        st.metric("對話總數", chat_count)
     with col2:
-        total_messages = sum(len(chat['messages']) for chat in st.session_state.chat_manager.chats.values())
         st.metric("訊息總數", total_messages)
     with col3:
         st.metric("關注股票", len(st.session_state.watched_stocks))
@@ -1240,13 +4107,20 @@ with col1:
 
 with col2:
     st.markdown("**📊 實時數據**")
-    st.caption(f"股票: {len(st.session_state.watched_stocks)} | 對話: {len(st.session_state.chat_manager.chats)}")
+    st.caption(f"股票: {len(st.session_state.watched_stocks)} | 對話: {st.session_state.chat_manager.count()[0]}")
 
 with col3:
-    current_hour = get_taiwan_time().hour
-    market_status = "🟢 開盤中" if 22 <= current_hour or current_hour <= 5 else "🔴 休市"
-    st.markdown(f"**{market_status}**")
-    st.caption("美股交易狀態")
+    market_calendar = get_market_calendar()
+    if market_calendar.is_open():
+        st.markdown("**🟢 開盤中**")
+        st.caption("美股交易狀態")
+    else:
+        st.markdown("**🔴 休市**")
+        next_open = market_calendar.next_open()
+        if next_open:
+            st.caption(f"美股下次開盤：{next_open.astimezone(TAIWAN_TZ).strftime('%m/%d %H:%M')}（台灣時間）")
+        else:
+            st.caption("美股交易狀態")
 
 with col4:
     taiwan_time = get_taiwan_time()